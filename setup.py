@@ -22,8 +22,6 @@ setup(name='ukpopulation',
     'pandas',
     'requests',
     'openpyxl',
-    'beautifulsoup4',
-    'lxml',
     'ukcensusapi'
   ],
   dependency_links=['git+https://github.com/virgesmith/UKCensusAPI.git@master#egg=ukcensusapi-1.0.0'],
@@ -5,9 +5,11 @@ create a small subset of real data for testing - 3 LADs per country and years up
 test data is under source control - this script only required if the data format changes
 NOTE: ensure NOMIS_API_KEY=DUMMY in order to match the cached filenames for England
 """
+import os
 import pandas as pd
+import ukpopulation.cache as cache
 
-real_data_dir = "~/.ukpopulation/cache/"
+real_data_dir = os.path.expanduser("~/.ukpopulation/cache/")
 test_data_dir = "./tests/raw_data/"
 
 def setup_snpp_data():
@@ -19,7 +21,8 @@ def setup_snpp_data():
 
   for file in raw_files:
     sep = "\t" if file[-4:] == ".tsv" else ","
-    df = pd.read_csv(real_data_dir + file, sep=sep)
+    # preprocessed data is stored in the binary cache (test data is kept as csv)
+    df = pd.read_csv(real_data_dir + file, sep=sep) if sep == "\t" else cache.read(real_data_dir + file)
 
     geogs = df.GEOGRAPHY_CODE.unique()[:3]
     df = df[(df.GEOGRAPHY_CODE.isin(geogs)) & (df.PROJECTED_YEAR_NAME < 2028)]
@@ -38,7 +41,8 @@ def setup_npp_data():
   
   for file in raw_files:
     sep = "\t" if file[-4:] == ".tsv" else ","
-    df = pd.read_csv(real_data_dir + file, sep=sep)
+    # preprocessed data is stored in the binary cache (test data is kept as csv)
+    df = pd.read_csv(real_data_dir + file, sep=sep) if sep == "\t" else cache.read(real_data_dir + file)
     df = df[(df.PROJECTED_YEAR_NAME < 2036)]
     df.to_csv(test_data_dir + file, sep=sep, index=False)
 
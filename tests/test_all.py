@@ -1,24 +1,183 @@
 import sys
 import os
+import io
+import shutil
+import tempfile
 import unittest
+import zipfile
+import hashlib
+import threading
+import http.server
+import socketserver
+import json
+import time
+import pickle
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
+import pandas as pd
 
 #import ukcensusapi.Nomisweb as Api
 import ukpopulation.myedata as MYEData
 import ukpopulation.nppdata as NPPData
 import ukpopulation.snppdata as SNPPData
 import ukpopulation.utils as utils
+import ukpopulation.cache as cache
+import ukpopulation.download as download
+import ukpopulation.rollup as rollup
+import ukpopulation.agebands as agebands
+from ukpopulation.cube import Cube
+
+def _npp_xml(years, value):
+  """
+  Generates a minimal NPP variant SpreadsheetML file (as a string) in which every population is value
+  """
+  ages = [str(a) for a in range(0,105)] + ["105 - 109", "110 and over"]
+  def row(cells):
+    return "<Row>" + "".join('<Cell><Data ss:Type="String">{}</Data></Cell>'.format(c) for c in cells) + "</Row>\n"
+  xml = '<?xml version="1.0"?>\n<Workbook xmlns="urn:schemas-microsoft-com:office:spreadsheet" ' \
+        'xmlns:ss="urn:schemas-microsoft-com:office:spreadsheet">\n'
+  xml += '<Worksheet ss:Name="Notes"><Table>' + row(["Sex", "Age"] + ["x"] * len(years)) + '</Table></Worksheet>\n'
+  xml += '<Worksheet ss:Name="Population"><Table>\n' + row(["Sex", "Age"] + list(years))
+  for gender in [1, 2]:
+    for age in ages:
+      xml += row([gender, " " + age] + [value] * len(years))
+  return xml + "</Table></Worksheet>\n</Workbook>\n"
+
+def _test_cache(exclude=None):
+  """
+  Creates a (temporary) cache directory containing the test data files, except those whose names start with exclude
+  """
+  cache_dir = tempfile.mkdtemp()
+  for file in os.listdir("./tests/raw_data"):
+    if os.path.isfile(os.path.join("./tests/raw_data", file)) and not (exclude and file.startswith(exclude)):
+      shutil.copy(os.path.join("./tests/raw_data", file), cache_dir)
+  return cache_dir
+
+def _npp_test_cache(variants):
+  """
+  Creates a cache directory containing the nomisweb test data and zipped NPP variant files (but no preprocessed variants)
+  """
+  cache_dir = _test_cache(exclude="npp_")
+  for country in utils.UK:
+    with zipfile.ZipFile(os.path.join(cache_dir, "npp_" + country + ".zip"), "w") as z:
+      for i, variant in enumerate(variants):
+        z.writestr(country + "_" + variant + "_opendata2016.xml", _npp_xml(range(2016, 2019), i + 1))
+  return cache_dir
+
+def _shared_worker(cache_dir):
+  """
+  Attaches to the published data from another process
+  """
+  snpp = SNPPData.SNPPData(cache_dir, shared=True)
+  npp = NPPData.NPPData(cache_dir, shared=True)
+  agg = snpp.aggregate(["GENDER", "C_AGE"], "W06000001", [2016, 2020]).OBS_VALUE.sum()
+  detail = npp.detail("hhh", utils.WA, [2020]).OBS_VALUE.sum()
+  return (isinstance(snpp.cubes[utils.WA].values, np.memmap), utils.WA in snpp.data, agg, detail)
+
+def _publish_worker(location):
+  """
+  Attaches to (or if not yet published, builds) a shared cube, recording each build
+  """
+  def build():
+    with open(location + ".builds", "a") as fd:
+      fd.write("built\n")
+    # (so that the other processes arrive while it is being built)
+    time.sleep(0.5)
+    return Cube(np.ones((1, 1, 2, 91)), np.array(["E06000001"], dtype=object), np.array([2016]), np.array([1, 2]), np.arange(91))
+  return float(Cube.shared(location, build).values.sum())
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  """
+  Threaded local HTTP server (http.server.ThreadingHTTPServer requires python 3.7)
+  """
+  daemon_threads = True
+
+class _FileHandler(http.server.BaseHTTPRequestHandler):
+  """
+  Local stand-in for the data providers' web servers, serving FILES (supporting range requests if RANGES)
+  """
+  FILES = {}
+  RANGES = True
+  # (path, Range header) of each request received
+  log = []
+
+  def do_GET(self):
+    _FileHandler.log.append((self.path, self.headers.get("Range")))
+    if not self.path in _FileHandler.FILES:
+      self.send_error(404)
+      return
+    content = _FileHandler.FILES[self.path]
+    if _FileHandler.RANGES and self.headers.get("Range"):
+      start = int(self.headers["Range"][6:-1])
+      if start >= len(content):
+        self.send_error(416)
+        return
+      self.send_response(206)
+      self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(content) - 1, len(content)))
+      content = content[start:]
+    else:
+      self.send_response(200)
+    self.send_header("Content-Length", str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, format, *args):
+    pass
+
+class _ODataHandler(http.server.BaseHTTPRequestHandler):
+  """
+  Local stand-in for the StatsWales OData service, serving RECORDS at most PAGE_SIZE per request (and reporting
+  the total count if COUNT, otherwise linking to the next page)
+  """
+  RECORDS = [{"Area_AltCode1": lad, "Year_Code": year, "Data": 1000.0 * year + 10 * age + gender,
+              "Gender_Code": "MF"[gender - 1], "Age_Code": age_code}
+             for lad in ["W06000001", "W06000002"] for year in [2016, 2017] for gender in [1, 2]
+             for age, age_code in enumerate(["{:02d}".format(a) for a in range(90)] + ["90Plus", "AllAges", "16To64"])]
+  PAGE_SIZE = 70
+  COUNT = True
+  log = []
+
+  def do_GET(self):
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+    _ODataHandler.log.append(query)
+    skip = int(query.get("$skip", ["0"])[0])
+    top = min(int(query.get("$top", ["1000000"])[0]), _ODataHandler.PAGE_SIZE)
+    result = {"value": _ODataHandler.RECORDS[skip:skip + top]}
+    if _ODataHandler.COUNT:
+      if "$inlinecount" in query:
+        result["odata.count"] = str(len(_ODataHandler.RECORDS))
+    elif skip + top < len(_ODataHandler.RECORDS):
+      result["odata.nextLink"] = "http://{}:{}/dataset?$skip={}".format(*self.server.server_address, skip + top)
+    content = json.dumps(result).encode()
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, format, *args):
+    pass
 
 class Test(unittest.TestCase):
 
+  @classmethod
+  def setUpClass(cls):
+    # (so that the tests never write to the test data directory)
+    cls.cache_dir = _test_cache()
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.cache_dir)
+
   def setUp(self):
     """ 
     Check env set up correctly for tests
     (it's too late to override the env in this function unfortunately)
     """
-    self.mye = MYEData.MYEData("./tests/raw_data")    
-    self.npp = NPPData.NPPData("./tests/raw_data")    
-    self.snpp = SNPPData.SNPPData("./tests/raw_data")    
+    self.mye = MYEData.MYEData(self.cache_dir)    
+    self.npp = NPPData.NPPData(self.cache_dir)    
+    self.snpp = SNPPData.SNPPData(self.cache_dir)    
 
     if not self.npp.data_api.key == "DUMMY" or not self.snpp.data_api.key == "DUMMY":
       print("Test requires NOMIS_API_KEY=DUMMY in env")
@@ -32,6 +191,15 @@ class Test(unittest.TestCase):
     self.assertEqual(min(ex_range), 2028)
     self.assertEqual(max(ex_range), max(year_range))
 
+    collector = utils.Collector()
+    self.assertEqual(len(collector.result()), 0)
+    for i in range(3):
+      collector.add(pd.DataFrame({"C_AGE": [i, i], "OBS_VALUE": [1.0, 2.0]}))
+    self.assertEqual(len(collector), 3)
+    data = collector.result()
+    self.assertEqual(list(data.index), list(range(6)))
+    self.assertEqual(list(data.C_AGE), [0, 0, 1, 1, 2, 2])
+
   def test_mye(self):
     self.assertEqual(self.mye.min_year(), 1991)
     self.assertEqual(self.mye.max_year(), 2016) # for test data, real data is 2039
@@ -46,6 +214,46 @@ class Test(unittest.TestCase):
     self.assertEqual(self.mye.aggregate(year, "E09000001", ["GENDER", "C_AGE"], ages=range(16,75)).OBS_VALUE.sum(), 6333)
     self.assertEqual(self.mye.filter(year, "E09000001", ages=range(16,75)).OBS_VALUE.sum(), 6333)
 
+  def test_mye_bulk(self):
+    # substitute an api that records queries and returns the same LAD for every requested year
+    class Api:
+      def __init__(self):
+        self.queries = []
+      def get_data(self, table, query_params):
+        self.queries.append(dict(query_params))
+        dates = query_params["date"].split(",")
+        data = pd.DataFrame({"GEOGRAPHY_CODE": "E09000001", "GENDER": 1, "C_AGE": 101 + np.arange(91), "OBS_VALUE": 1})
+        if len(dates) == 1:
+          return data
+        years = [MYEData.MYEData.MAX_YEAR - int(d[11:]) if d != "latest" else MYEData.MYEData.MAX_YEAR for d in dates]
+        return pd.concat([data.assign(DATE_NAME=year) for year in years], ignore_index=True)
+
+    # years loaded one at a time are stored separately, not appended to (a copy of) everything already loaded
+    mye = MYEData.MYEData(self.cache_dir)
+    mye.data_api = Api()
+    mye.filter(1991, "E09000001")
+    first = mye.years[1991]
+    self.assertEqual(len(mye.filter([1991, 1992], "E09000001")), 2 * 91)
+    self.assertIs(mye.years[1991], first)
+    self.assertEqual(len(mye.data_api.queries), 2)
+    self.assertTrue(np.array_equal(mye.data.index.unique(), [1991, 1992]))
+
+    mye = MYEData.MYEData(self.cache_dir)
+    mye.data_api = Api()
+    mye.preload()
+    # 26 years in 2 queries
+    self.assertEqual(len(mye.data_api.queries), 2)
+    self.assertEqual(mye.data_api.queries[1]["date"].split(",")[-1], "latest")
+    data = mye.filter(range(1991, 2017), "E09000001")
+    self.assertEqual(len(data), 26 * 91)
+    self.assertTrue(np.array_equal(data.PROJECTED_YEAR_NAME.unique(), range(1991, 2017)))
+    self.assertTrue(np.array_equal(data.C_AGE.unique(), range(0, 91)))
+    # already loaded
+    mye.filter(2011, "E09000001")
+    self.assertEqual(len(mye.data_api.queries), 2)
+
+    self.assertRaises(ValueError, self.mye.filter, 1990, "E09000001")
+
   def test_snpp(self):
 
     # NB this is the test data (real data is 2016-2041)
@@ -71,6 +279,325 @@ class Test(unittest.TestCase):
     self.assertEqual(len(agg), 2)
     self.assertEqual(agg.OBS_VALUE.sum(), 349517) # remember this is population under 46
 
+  def test_snpp_lazy(self):
+    # only the legacy CSV caches, which preload migrates rather than downloading the raw data
+    cache_dir = _test_cache()
+    try:
+      snpp = SNPPData.SNPPData(cache_dir)
+      self.assertCountEqual(list(snpp.data.keys()), [])
+      snpp.filter("E06000001", 2016)
+      self.assertCountEqual(list(snpp.data.keys()), [utils.EN])
+      self.assertEqual(snpp.max_year("S12000033"), 2027)
+      self.assertCountEqual(list(snpp.data.keys()), [utils.EN, utils.SC])
+      snpp.preload()
+      self.assertCountEqual(list(snpp.data.keys()), utils.UK)
+      self.assertFalse(os.path.exists(os.path.join(cache_dir, "ni_raw.xlsx")))
+    finally:
+      shutil.rmtree(cache_dir)
+
+  def test_snpp_pickle(self):
+    # e.g. to pass to a process pool
+    for snpp in [SNPPData.SNPPData(self.cache_dir), SNPPData.SNPPData(self.cache_dir, dense=True)]:
+      snpp.filter("E06000001", 2016)
+      copy = pickle.loads(pickle.dumps(snpp))
+      self.assertEqual(list(copy.data.keys()), list(snpp.data.keys()))
+      self.assertEqual(list(copy.cubes.keys()), list(snpp.cubes.keys()))
+      # and still loads lazily
+      self.assertTrue(copy.filter(["E06000001", "W06000011"], 2016).equals(snpp.filter(["E06000001", "W06000011"], 2016)))
+
+  def test_filter_categories(self):
+    # a (default, observed=False) groupby on filtered data has no empty groups for the unselected geographies
+    dense = SNPPData.SNPPData(self.cache_dir, dense=True)
+    for snpp in [self.snpp, dense]:
+      self.assertEqual(len(snpp.filter("E06000001", [2020]).groupby(["GEOGRAPHY_CODE", "GENDER"]).OBS_VALUE.sum()), 2)
+      self.assertEqual(len(snpp.filter(["E06000001", "W06000011"], [2020]).groupby(["GEOGRAPHY_CODE", "GENDER"]).OBS_VALUE.sum()), 4)
+      self.assertEqual(len(snpp.aggregate("C_AGE", "E06000001", [2020]).groupby(["GEOGRAPHY_CODE", "GENDER"]).OBS_VALUE.sum()), 2)
+    self.assertEqual(len(self.mye.filter(2011, "E09000001").groupby(["GEOGRAPHY_CODE", "GENDER"]).OBS_VALUE.sum()), 2)
+    self.assertEqual(len(self.mye.aggregate(2011, "E09000001", "C_AGE").groupby(["GEOGRAPHY_CODE", "GENDER"]).OBS_VALUE.sum()), 2)
+
+  def test_snpp_dense(self):
+    dense = SNPPData.SNPPData(self.cache_dir, dense=True)
+
+    geogs = ["E06000001","E06000005"]
+    cols = ["GEOGRAPHY_CODE", "PROJECTED_YEAR_NAME", "GENDER", "C_AGE"]
+    data = self.snpp.filter(geogs, range(2016,2020), ages=range(16,75)).sort_values(cols).reset_index(drop=True)
+    ddata = dense.filter(geogs, range(2016,2020), ages=range(16,75))
+    self.assertEqual(len(ddata), len(data))
+    self.assertTrue(np.array_equal(ddata[cols].values, data[cols].values))
+    self.assertTrue(np.allclose(ddata.OBS_VALUE, data.OBS_VALUE.astype(float)))
+
+    for categories in [["GENDER", "C_AGE"], ["GEOGRAPHY_CODE", "GENDER"], "C_AGE"]:
+      agg = self.snpp.aggregate(categories, ["S12000033","S12000041"], [2016, 2017])
+      dagg = dense.aggregate(categories, ["S12000033","S12000041"], [2016, 2017])
+      self.assertTrue(np.array_equal(agg.columns, dagg.columns))
+      self.assertTrue(np.allclose(agg.OBS_VALUE.astype(float), dagg.OBS_VALUE))
+
+    self.assertEqual(len(dense.filter(["E06000001","S12000041"], [2040])), 0)
+    # only the dense representation is retained
+    self.assertFalse(utils.EN in dense.data or utils.SC in dense.data)
+    # the dataframe is constructed from the cube on access (and not retained)
+    frame = dense.data[utils.EN]
+    self.assertEqual(len(frame), len(self.snpp.data[utils.EN]))
+    self.assertTrue(np.array_equal(frame[cols].values, self.snpp.data[utils.EN].sort_values(cols)[cols].values))
+    self.assertFalse(utils.EN in dense.data)
+    self.assertRaises(ValueError, dense.aggregate, ["INVALID_CAT"], ["E06000001"], [2016])
+
+  def test_shared(self):
+    cache_dir = _test_cache()
+    try:
+      # publish
+      snpp = SNPPData.SNPPData(cache_dir, shared=True)
+      npp = NPPData.NPPData(cache_dir, shared=True)
+      agg = snpp.aggregate(["GENDER", "C_AGE"], "W06000001", [2016, 2020])
+      self.assertTrue(np.allclose(agg.OBS_VALUE, self.snpp.aggregate(["GENDER", "C_AGE"], "W06000001", [2016, 2020]).OBS_VALUE))
+      self.assertEqual(snpp.min_year(utils.WA), self.snpp.min_year(utils.WA))
+      self.assertEqual(snpp.max_year(utils.WA), self.snpp.max_year(utils.WA))
+      self.assertTrue(np.allclose(npp.variant_ratios("hhh").values, self.npp.variant_ratios("hhh").values, equal_nan=True))
+      self.assertTrue(os.path.isdir(cache.path(os.path.join(cache_dir, "snpp_" + utils.WA + "_cube.csv"))))
+      self.assertTrue(os.path.isdir(cache.path(os.path.join(cache_dir, "npp_hhh_cube.csv"))))
+      # read-only
+      self.assertFalse(snpp.cubes[utils.WA].values.flags.writeable)
+
+      # attach from other processes
+      with ProcessPoolExecutor(max_workers=2) as executor:
+        for (mapped, loaded, wagg, detail) in executor.map(_shared_worker, [cache_dir] * 2):
+          self.assertTrue(mapped)
+          self.assertFalse(loaded)
+          self.assertAlmostEqual(wagg, agg.OBS_VALUE.sum())
+          self.assertAlmostEqual(detail, self.npp.detail("hhh", utils.WA, [2020]).OBS_VALUE.sum())
+
+      # processes arriving at an unpublished cube concurrently build it once
+      location = os.path.join(cache_dir, "concurrent_cube.v" + str(cache.VERSION))
+      with ProcessPoolExecutor(max_workers=4) as executor:
+        self.assertEqual(list(executor.map(_publish_worker, [location] * 4)), [182.0] * 4)
+      with open(location + ".builds") as fd:
+        self.assertEqual(len(fd.readlines()), 1)
+    finally:
+      shutil.rmtree(cache_dir)
+
+  def test_snpp_mixed_countries(self):
+    lads = ["E06000001", "W06000011", "S12000033", "N09000001", "E06000005"]
+    for snpp in [self.snpp, SNPPData.SNPPData(self.cache_dir, dense=True)]:
+      data = snpp.filter(lads, [2020, 2025])
+      self.assertEqual(data.GEOGRAPHY_CODE.dtype, "category")
+      self.assertCountEqual(data.GEOGRAPHY_CODE.unique(), lads)
+      for lad in lads:
+        self.assertAlmostEqual(data[data.GEOGRAPHY_CODE == lad].OBS_VALUE.sum(), self.snpp.filter(lad, [2020, 2025]).OBS_VALUE.sum())
+
+      agg = snpp.aggregate(["GEOGRAPHY_CODE", "GENDER", "C_AGE"], lads, [2020, 2025])
+      self.assertEqual(len(agg), 2)
+      self.assertTrue(np.allclose(agg.OBS_VALUE, data.groupby("PROJECTED_YEAR_NAME").OBS_VALUE.sum()))
+      agg = snpp.aggregate(["GENDER", "C_AGE"], lads, [2020])
+      self.assertEqual(sorted(agg.GEOGRAPHY_CODE), sorted(lads))
+
+      # country codes
+      self.assertEqual(len(snpp.filter([utils.WA, utils.NI], [2020])), len(self.snpp.filter(utils.WA, [2020])) + len(self.snpp.filter(utils.NI, [2020])))
+
+      years = range(2025, 2036)
+      ex = snpp.extrapolagg(["GENDER", "C_AGE"], self.npp, lads, years)
+      self.assertEqual(len(ex), len(lads) * len(years))
+      for lad in lads:
+        self.assertTrue(np.allclose(ex[ex.GEOGRAPHY_CODE == lad].OBS_VALUE, self.snpp.extrapolagg(["GENDER", "C_AGE"], self.npp, lad, years).OBS_VALUE))
+
+      variants = snpp.create_variants(["hhh", "lll"], self.npp, lads, range(2025, 2030))
+      for lad in lads:
+        single = self.snpp.create_variant("lll", self.npp, lad, range(2025, 2030))
+        self.assertAlmostEqual(variants["lll"][variants["lll"].GEOGRAPHY_CODE == lad].OBS_VALUE.sum(), single.OBS_VALUE.sum())
+
+    self.assertRaises(ValueError, self.snpp.filter, [], [2020])
+
+  def test_rollup(self):
+    years = [2020, 2025]
+    totals = self.snpp.rollup(years=years)
+    self.assertCountEqual(totals.GEOGRAPHY_CODE.unique(), rollup.GROUPINGS.keys())
+    self.assertEqual(len(totals), len(rollup.GROUPINGS) * 2 * 2 * 91)
+    national = totals.groupby(["GEOGRAPHY_CODE", "PROJECTED_YEAR_NAME"], observed=True).OBS_VALUE.sum()
+    country = {}
+    for c in utils.UK:
+      country[c] = self.snpp.aggregate(["GEOGRAPHY_CODE", "GENDER", "C_AGE"], c, years).OBS_VALUE.values
+      self.assertTrue(np.allclose(national[utils.CODES[c]].values, country[c]))
+    self.assertTrue(np.allclose(national["K04000001"].values, country[utils.EN] + country[utils.WA]))
+    self.assertTrue(np.allclose(national["K02000001"].values, sum(country.values())))
+    # cached, and the same in dense mode
+    self.assertEqual(len(self.snpp.rollups), 1)
+    dense = SNPPData.SNPPData(self.cache_dir, dense=True).rollup(years=[2020], ages=range(16,65), genders=2)
+    self.assertTrue(np.allclose(dense.OBS_VALUE, totals[totals.PROJECTED_YEAR_NAME.isin([2020]) & totals.C_AGE.isin(range(16,65)) & (totals.GENDER == 2)].OBS_VALUE))
+
+    # user-defined (overlapping) groups
+    groups = {"X1": ["E06000001", "E06000005"], "X2": ["E06000005", "W06000011", "N09000001"], "X3": ["E99999999"]}
+    totals = self.snpp.rollup(groups, [2020])
+    self.assertCountEqual(totals.GEOGRAPHY_CODE.unique(), ["X1", "X2"])
+    for group in ["X1", "X2"]:
+      self.assertAlmostEqual(totals[totals.GEOGRAPHY_CODE == group].OBS_VALUE.sum(), self.snpp.filter(groups[group], [2020]).OBS_VALUE.sum())
+
+    # generic rollup of other outputs
+    ex = self.snpp.extrapolate(self.npp, ["E06000001", "W06000011"], [2030, 2040])
+    totals = rollup.rollup(ex)
+    self.assertCountEqual(totals.GEOGRAPHY_CODE.unique(), ["E92000001", "W92000004", "K04000001", "K03000001", "K02000001"])
+    self.assertAlmostEqual(totals[totals.GEOGRAPHY_CODE == "K02000001"].OBS_VALUE.sum(), ex.OBS_VALUE.sum())
+
+    mye = self.mye.rollup(2011)
+    self.assertAlmostEqual(mye[mye.GEOGRAPHY_CODE == "K02000001"].OBS_VALUE.sum(), self.mye.data.loc[2011].OBS_VALUE.sum())
+    # computed once per grouping and year
+    cached = self.mye.rollups[(None, 2011)]
+    female = self.mye.rollup(2011, genders=2)
+    self.assertIs(self.mye.rollups[(None, 2011)], cached)
+    self.assertAlmostEqual(female[female.GEOGRAPHY_CODE == "K02000001"].OBS_VALUE.sum(), self.mye.filter(2011, self.mye.data.loc[2011].GEOGRAPHY_CODE.unique(), genders=2).OBS_VALUE.sum())
+    groups = {"X1": ["E09000001", "E09000002"]}
+    self.assertAlmostEqual(self.mye.rollup(2011, groups).OBS_VALUE.sum(), self.mye.filter(2011, groups["X1"]).OBS_VALUE.sum())
+
+  def test_agebands(self):
+    self.assertEqual(agebands.FIVE_YEAR.matrix.shape, (91, 19))
+    self.assertEqual(list(agebands.FIVE_YEAR.labels[[0, 1, -1]]), ["0-4", "5-9", "90+"])
+    self.assertTrue(np.array_equal(agebands.FIVE_YEAR.matrix.sum(axis=1), np.ones(91)))
+
+    def check(banded, aggregate, bands=agebands.BROAD):
+      # compare with aggregating each band separately
+      self.assertEqual(list(banded.AGE_BAND.unique()), list(bands.labels))
+      for band in bands.labels:
+        ages = list(np.nonzero(bands.matrix[:, list(bands.labels).index(band)])[0])
+        expected = aggregate(ages)
+        keys = [column for column in expected.columns if column != "OBS_VALUE"]
+        actual = banded[banded.AGE_BAND == band].sort_values(keys)
+        self.assertTrue(np.allclose(actual.OBS_VALUE, expected.sort_values(keys).OBS_VALUE))
+
+    lads = ["E06000001", "W06000011", "E06000005"]
+    for snpp in [self.snpp, SNPPData.SNPPData(self.cache_dir, dense=True)]:
+      banded = snpp.aggregate(["GENDER"], lads, [2020, 2021], bands=agebands.BROAD)
+      self.assertEqual(list(banded.columns), ["AGE_BAND", "GEOGRAPHY_CODE", "PROJECTED_YEAR_NAME", "OBS_VALUE"])
+      check(banded, lambda ages: snpp.aggregate(["GENDER", "C_AGE"], lads, [2020, 2021], ages=ages))
+      banded = snpp.aggregate(["GENDER", "GEOGRAPHY_CODE"], lads, [2020], bands=agebands.FIVE_YEAR)
+      check(banded, lambda ages: snpp.aggregate(["GENDER", "C_AGE", "GEOGRAPHY_CODE"], lads, [2020], ages=ages), agebands.FIVE_YEAR)
+      self.assertRaises(ValueError, snpp.aggregate, ["C_AGE"], lads, [2020], bands=agebands.BROAD)
+
+    check(self.snpp.extrapolagg(["GENDER", "GEOGRAPHY_CODE"], self.npp, "E06000001", range(2025, 2035), bands=agebands.BROAD),
+          lambda ages: utils.aggregate(utils.filter_by_age(self.snpp.extrapolate(self.npp, "E06000001", range(2025, 2035)), ages), ["GENDER", "GEOGRAPHY_CODE", "C_AGE"]))
+    check(self.npp.aggregate(["GENDER"], "ppp", [utils.EN, utils.WA], [2020, 2050], bands=agebands.BROAD),
+          lambda ages: self.npp.aggregate(["GENDER", "C_AGE"], "ppp", [utils.EN, utils.WA], [2020, 2050], ages=ages))
+    check(self.mye.aggregate(2011, "E09000001", ["GENDER"], bands=agebands.BROAD),
+          lambda ages: self.mye.aggregate(2011, "E09000001", ["GENDER", "C_AGE"], ages=ages))
+
+    # overlapping, partial bands
+    bands = agebands.AgeBands([("under 5", range(0,5)), ("under 18", range(0,18)), ("90+", np.int64(90))])
+    banded = self.snpp.aggregate(["GENDER", "GEOGRAPHY_CODE"], lads, [2020], bands=bands)
+    check(banded, lambda ages: self.snpp.aggregate(["GENDER", "GEOGRAPHY_CODE", "C_AGE"], lads, [2020], ages=ages), bands)
+
+  def test_aggregate_pushdown(self):
+    # chunked, masked aggregation matches filtering then aggregating
+    data = self.snpp.filter(["E06000001", "E06000005"], range(2016, 2020))
+    subset = {"GEOGRAPHY_CODE": ["E06000005"], "PROJECTED_YEAR_NAME": [2017, 2019], "C_AGE": range(16, 75), "GENDER": [1, 2]}
+    expected = utils.aggregate(data[data.GEOGRAPHY_CODE.isin(["E06000005"]) & data.PROJECTED_YEAR_NAME.isin([2017, 2019]) &
+                                    data.C_AGE.isin(range(16, 75))], ["GENDER", "C_AGE"])
+    for chunk_size in [100, 1000, len(data)]:
+      agg = utils.aggregate(data, ["GENDER", "C_AGE"], subset, chunk_size)
+      self.assertTrue(np.array_equal(agg[["GEOGRAPHY_CODE", "PROJECTED_YEAR_NAME"]].values, expected[["GEOGRAPHY_CODE", "PROJECTED_YEAR_NAME"]].values))
+      self.assertTrue(np.allclose(agg.OBS_VALUE, expected.OBS_VALUE))
+
+    mye = self.mye.aggregate(2011, ["E09000001", "E09000002"], "C_AGE", ages=range(16, 75), genders=2)
+    self.assertTrue(np.allclose(mye.OBS_VALUE, utils.aggregate(self.mye.filter(2011, ["E09000001", "E09000002"], range(16, 75), 2), "C_AGE").OBS_VALUE))
+    npp = self.npp.aggregate(["GENDER"], "ppp", [utils.EN, utils.SC], [2020, 2030], ages=range(16, 75))
+    self.assertTrue(np.allclose(npp.OBS_VALUE, utils.aggregate(self.npp.detail("ppp", [utils.EN, utils.SC], [2020, 2030], range(16, 75)), "GENDER").OBS_VALUE))
+
+    # the array is contracted in place when complete, and sliced and summed (ignoring missing values) when not
+    cube = Cube.from_frame(data)
+    self.assertTrue(cube.complete())
+    incomplete = Cube.from_frame(data[~((data.GEOGRAPHY_CODE == "E06000005") & (data.C_AGE == 20))])
+    self.assertFalse(incomplete.complete())
+    for categories in [["GENDER", "C_AGE"], ["GEOGRAPHY_CODE", "GENDER"], "C_AGE"]:
+      agg = cube.aggregate(categories, ["E06000005"], [2017, 2019], range(16, 75))
+      self.assertTrue(np.allclose(agg.OBS_VALUE, utils.aggregate(data, categories, subset).OBS_VALUE))
+      agg = incomplete.aggregate(categories, ["E06000005"], [2017, 2019], range(16, 75))
+      self.assertTrue(np.allclose(agg.OBS_VALUE, utils.aggregate(data[data.C_AGE != 20], categories, subset).OBS_VALUE))
+
+  def test_query(self):
+    lads = ["E06000001", "W06000011", "E06000005"]
+    years = range(2020, 2035)
+    cols = ["GEOGRAPHY_CODE", "PROJECTED_YEAR_NAME", "GENDER", "C_AGE"]
+    for snpp in [self.snpp, SNPPData.SNPPData(self.cache_dir, dense=True)]:
+      query = snpp.query(self.npp).geographies(lads).years(years)
+      # steps return new queries
+      self.assertIsNone(query.plan["variant_names"])
+
+      data = query.run()
+      expected = snpp.extrapolate(self.npp, lads, years).sort_values(cols)
+      self.assertTrue(np.array_equal(data[cols].values, expected[cols].values))
+      self.assertTrue(np.allclose(data.OBS_VALUE, expected.OBS_VALUE))
+
+      variants = query.variant(["hhh", "lll"]).run()
+      expected = snpp.create_variants(["hhh", "lll"], self.npp, lads, years)
+      for variant_name in ["hhh", "lll"]:
+        self.assertTrue(np.allclose(variants[variant_name].OBS_VALUE, expected[variant_name].sort_values(cols).OBS_VALUE))
+
+      agg = query.variant("hhh").aggregate(["GENDER", "C_AGE"]).run()
+      expected = utils.aggregate(snpp.create_variant("hhh", self.npp, lads, years), ["GENDER", "C_AGE"])
+      self.assertTrue(np.allclose(agg.OBS_VALUE, expected.sort_values(["GEOGRAPHY_CODE", "PROJECTED_YEAR_NAME"]).OBS_VALUE))
+
+      agg = query.ages(range(16, 65)).genders(2).aggregate(["GEOGRAPHY_CODE", "C_AGE"]).run()
+      expected = snpp.extrapolate(self.npp, lads, years)
+      expected = utils.aggregate(expected[expected.C_AGE.isin(range(16, 65)) & (expected.GENDER == 2)], ["GEOGRAPHY_CODE", "C_AGE"])
+      self.assertTrue(np.allclose(agg.OBS_VALUE, expected.OBS_VALUE))
+
+      banded = query.aggregate(["GENDER", "GEOGRAPHY_CODE"], agebands.BROAD).run()
+      self.assertTrue(np.allclose(banded.OBS_VALUE, snpp.extrapolagg(["GENDER", "GEOGRAPHY_CODE"], self.npp, lads, years, agebands.BROAD).OBS_VALUE))
+
+    # no extrapolation needed
+    self.assertEqual(len(self.snpp.query().geographies("E06000001").years([2016, 2017]).run()), 2 * 2 * 91)
+    self.assertRaises(ValueError, self.snpp.query().geographies("E06000001").years(2030).run)
+    self.assertRaises(ValueError, self.snpp.query().geographies("E06000001").variant, "hhh")
+    self.assertRaises(ValueError, self.snpp.query().geographies("E06000001").aggregate, ["PROJECTED_YEAR_NAME"])
+    self.assertRaises(ValueError, self.snpp.query().run)
+
+  def test_snpp_iter(self):
+    years = range(2036, 2046)
+    data = self.snpp.extrapolagg(["GENDER", "C_AGE"], self.npp, utils.WA, years)
+    results = list(self.snpp.iter_extrapolagg(["GENDER", "C_AGE"], self.npp, utils.WA, years, chunk_size=5))
+    self.assertEqual([geog_code for (geog_code, _) in results], sorted(data.GEOGRAPHY_CODE.unique()))
+    for (geog_code, result) in results:
+      self.assertTrue(np.array_equal(result.GEOGRAPHY_CODE, [geog_code] * len(years)))
+      self.assertTrue(np.allclose(result.OBS_VALUE, data[data.GEOGRAPHY_CODE == geog_code].OBS_VALUE))
+    self.assertRaises(ValueError, self.snpp.iter_extrapolagg, ["GEOGRAPHY_CODE"], self.npp, utils.WA, years)
+
+    lads = ["E06000001", "E06000005", "E06000047"]
+    data = self.snpp.extrapolate(self.npp, lads, years)
+    for (geog_code, result) in self.snpp.iter_extrapolate(self.npp, lads, years, chunk_size=2):
+      self.assertEqual(len(result), len(years) * 2 * 91)
+      self.assertAlmostEqual(result.OBS_VALUE.sum(), data[data.GEOGRAPHY_CODE == geog_code].OBS_VALUE.sum())
+
+    years = range(2025, 2035)
+    variants = self.snpp.create_variants(["hhh", "lll"], self.npp, lads, years)
+    results = list(self.snpp.iter_variants(["hhh", "lll"], self.npp, lads, years, chunk_size=2))
+    self.assertEqual([geog_code for (geog_code, _) in results], lads)
+    for (geog_code, result) in results:
+      for variant in ["hhh", "lll"]:
+        self.assertAlmostEqual(result[variant].OBS_VALUE.sum(), variants[variant][variants[variant].GEOGRAPHY_CODE == geog_code].OBS_VALUE.sum())
+    hhh = dict(self.snpp.iter_variant("hhh", self.npp, lads, years))
+    self.assertEqual(list(hhh), lads)
+    self.assertTrue(np.allclose(hhh["E06000047"].OBS_VALUE, results[2][1]["hhh"].OBS_VALUE))
+
+    # streamed output
+    tmpdir = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(tmpdir, "extrapolated.csv")
+      rows = utils.write_stream(self.snpp.iter_extrapolagg(["GENDER", "C_AGE"], self.npp, utils.WA, years, chunk_size=5), filename)
+      written = pd.read_csv(filename)
+      self.assertEqual(rows, len(written))
+      self.assertEqual(list(written.columns), ["GEOGRAPHY_CODE", "PROJECTED_YEAR_NAME", "OBS_VALUE"])
+      self.assertAlmostEqual(written.OBS_VALUE.sum(), self.snpp.extrapolagg(["GENDER", "C_AGE"], self.npp, utils.WA, years).OBS_VALUE.sum())
+      # a single header, even if the first chunk is empty
+      filename = os.path.join(tmpdir, "empty_first.csv")
+      self.assertEqual(utils.write_stream([pd.DataFrame({"A": []}), pd.DataFrame({"A": [1, 2]})], filename), 2)
+      with open(filename) as fd:
+        self.assertEqual(fd.read().split(), ["A", "1", "2"])
+      filename = os.path.join(tmpdir, "extrapolated.parquet")
+      try:
+        import pyarrow
+        rows = utils.write_stream(self.snpp.iter_extrapolate(self.npp, lads, years), filename)
+        self.assertEqual(len(pd.read_parquet(filename)), rows)
+      except ImportError:
+        self.assertRaises(ImportError, utils.StreamWriter, filename)
+    finally:
+      shutil.rmtree(tmpdir)
+
   def test_snpp_errors(self):
     # invalid variant code
     #self.assertRaises(RuntimeError, self.snpp.filter, "xxx", utils.UK, [2016])
@@ -103,11 +630,58 @@ class Test(unittest.TestCase):
     # now hhh and ppp are present
     self.assertCountEqual(list(self.npp.data.keys()), ["ppp", "hhh"])
 
+    # repeated (memoised) queries are unaffected by changes to previous results
+    data.OBS_VALUE = 0
+    data = self.npp.detail("hhh", utils.EW, range(2016,2020))
+    self.assertEqual(data[data.PROJECTED_YEAR_NAME==2016].OBS_VALUE.sum(), 58381217) 
+
     # similar to above, but all of UK summed by age and gender
     agg = self.npp.aggregate(["GENDER", "C_AGE"], "hhh", utils.UK, [2016])
     self.assertEqual(len(agg), 4)
     self.assertEqual(agg.OBS_VALUE.sum(), 65648054) # remember this is population under 46
 
+  def test_npp_pickle(self):
+    npp = NPPData.NPPData(self.cache_dir)
+    for year in range(2016, 2016 + NPPData.NPPData.DETAIL_CACHE_SIZE + 5):
+      detail = npp.detail("ppp", utils.EN, [year])
+    # the memo is bounded
+    self.assertEqual(len(npp.details), NPPData.NPPData.DETAIL_CACHE_SIZE)
+    copy = pickle.loads(pickle.dumps(npp))
+    self.assertEqual(len(copy.details), 0)
+    self.assertTrue(copy.detail("ppp", utils.EN, [year]).equals(detail))
+
+  def test_npp_ratios(self):
+    ratios = self.npp.year_ratios("ppp", 2020)
+    ref = self.npp.detail("ppp", utils.SC, [2020], ages=[30], genders=[2]).OBS_VALUE.values[0]
+    num = self.npp.detail("ppp", utils.SC, [2030], ages=[30], genders=[2]).OBS_VALUE.values[0]
+    self.assertAlmostEqual(ratios.slice(utils.CODES[utils.SC], [2030], [30], [2])[0].item(), num / ref)
+    self.assertTrue(np.allclose(ratios.slice(None, [2020])[0], 1.0))
+    # cached
+    self.assertIs(self.npp.year_ratios("ppp", 2020), ratios)
+    self.assertRaises(ValueError, self.npp.year_ratios, "ppp", 1900)
+
+    ratio = self.npp.year_ratio("ppp", utils.SC, 2020, 2030, ages=[30], genders=[2])
+    self.assertEqual(len(ratio), 1)
+    self.assertAlmostEqual(ratio.OBS_VALUE.values[0], num / ref)
+
+    ratio = self.npp.variant_ratio("hhh", utils.WA, range(2016,2020))
+    self.assertEqual(len(ratio), 4 * 2 * 91)
+    hhh = self.npp.detail("hhh", utils.WA, [2019], ages=[0], genders=[1]).OBS_VALUE.values[0]
+    ppp = self.npp.detail("ppp", utils.WA, [2019], ages=[0], genders=[1]).OBS_VALUE.values[0]
+    self.assertAlmostEqual(ratio.loc[(0, 1, 2019)].OBS_VALUE, hhh / ppp)
+
+    # persisted ratio tables
+    cache_dir = _npp_test_cache(["hhh"])
+    try:
+      npp = NPPData.NPPData(cache_dir, persist_ratios=True)
+      ratios = npp.variant_ratios("hhh")
+      self.assertTrue(os.path.isdir(cache.path(os.path.join(cache_dir, "npp_hhh_ratio_ppp.csv"))))
+      reloaded = NPPData.NPPData(cache_dir, persist_ratios=True).variant_ratios("hhh")
+      self.assertTrue(np.array_equal(ratios.values, reloaded.values))
+      self.assertTrue(np.array_equal(ratios.labels[0], reloaded.labels[0]))
+    finally:
+      shutil.rmtree(cache_dir)
+
   def test_npp_errors(self):
     # invalid variant code
     self.assertRaises(RuntimeError, self.npp.detail, "xxx", utils.UK, [2016])
@@ -129,7 +703,23 @@ class Test(unittest.TestCase):
     years = range(self.snpp.max_year(utils.EN)-1, self.snpp.max_year(utils.EN) + 2)
     ext = utils.aggregate(self.snpp.extrapolate(self.npp, "E06000001", years), ["GENDER", "C_AGE"])
     extagg = self.snpp.extrapolagg(["GENDER", "C_AGE"], self.npp, "E06000001", years)
-    self.assertTrue(ext.equals(extagg))
+    self.assertTrue(np.array_equal(ext[["GEOGRAPHY_CODE", "PROJECTED_YEAR_NAME"]].values, extagg[["GEOGRAPHY_CODE", "PROJECTED_YEAR_NAME"]].values))
+    self.assertTrue(np.allclose(ext.OBS_VALUE, extagg.OBS_VALUE))
+
+    # test all LADs in a country at once is equivalent to one at a time
+    years = range(self.snpp.max_year(utils.WA), self.snpp.max_year(utils.WA) + 5)
+    ext = self.snpp.extrapolate(self.npp, utils.WA, years)
+    self.assertCountEqual(ext.GEOGRAPHY_CODE.unique(), ["W06000011", "W06000016", "W06000018"])
+    for lad in ext.GEOGRAPHY_CODE.unique():
+      single = self.snpp.extrapolate(self.npp, lad, years)
+      self.assertEqual(len(single), len(ext[ext.GEOGRAPHY_CODE == lad]))
+      self.assertAlmostEqual(single.OBS_VALUE.sum(), ext[ext.GEOGRAPHY_CODE == lad].OBS_VALUE.sum())
+
+    # check extrapolated values are scaled by the NPP ratio for the same age and gender
+    ext = self.snpp.extrapolate(self.npp, "N09000001", [2028])
+    base = self.snpp.filter("N09000001", [2027], ages=[90], genders=[1]).OBS_VALUE.values[0]
+    npp = self.npp.detail("ppp", utils.NI, [2027, 2028], ages=[90], genders=[1]).OBS_VALUE.values
+    self.assertAlmostEqual(ext[(ext.C_AGE == 90) & (ext.GENDER == 1)].OBS_VALUE.values[0], base * npp[1] / npp[0])
 
   def test_snpp_variant(self):
     # test variant projection 
@@ -145,6 +735,291 @@ class Test(unittest.TestCase):
     # TODO more testing of results
     self.assertTrue(np.array_equal(base.OBS_VALUE, ppp.OBS_VALUE))
 
+    # variant scales each age/gender by the NPP variant/principal ratio
+    hhh = self.snpp.create_variant("hhh", self.npp, "S12000034", [2020])
+    base = self.snpp.filter("S12000034", [2020], ages=[50], genders=[2]).OBS_VALUE.values[0]
+    npp_hhh = self.npp.detail("hhh", utils.SC, [2020], ages=[50], genders=[2]).OBS_VALUE.values[0]
+    npp_ppp = self.npp.detail("ppp", utils.SC, [2020], ages=[50], genders=[2]).OBS_VALUE.values[0]
+    self.assertAlmostEqual(hhh[(hhh.C_AGE == 50) & (hhh.GENDER == 2)].OBS_VALUE.values[0], base * npp_hhh / npp_ppp)
+
+    # batch of variants for every LAD in a country (extrapolating too)
+    years = range(2016, self.snpp.max_year(utils.SC) + 3)
+    variants = self.snpp.create_variants(["ppp", "hhh", "lll"], self.npp, utils.SC, years)
+    self.assertCountEqual(variants.keys(), ["ppp", "hhh", "lll"])
+    for variant in variants:
+      self.assertEqual(len(variants[variant]), 3 * len(years) * 2 * 91)
+      single = self.snpp.create_variant(variant, self.npp, "S12000033", years)
+      self.assertAlmostEqual(single.OBS_VALUE.sum(), variants[variant][variants[variant].GEOGRAPHY_CODE == "S12000033"].OBS_VALUE.sum())
+
+  def test_cache(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      # migrate legacy csv
+      csvfile = os.path.join(tmpdir, "snpp_x.csv")
+      shutil.copy("./tests/raw_data/snpp_ni.csv", csvfile)
+      legacy = pd.read_csv(csvfile)
+      migrated = cache.read(csvfile)
+      self.assertTrue(os.path.isdir(cache.path(csvfile)))
+      (_, meta) = cache.load_arrays(cache.path(csvfile))
+      self.assertEqual(meta["source"]["size"], os.path.getsize(csvfile))
+      # a changed csv is converted again, replacing the stale cache and any caches of previous versions
+      os.mkdir(os.path.join(tmpdir, "snpp_x.v1"))
+      legacy.head(10).to_csv(csvfile, index=False)
+      self.assertEqual(len(cache.read(csvfile)), 10)
+      self.assertFalse(os.path.isdir(os.path.join(tmpdir, "snpp_x.v1")))
+      legacy.to_csv(csvfile, index=False)
+      migrated = cache.read(csvfile)
+      self.assertEqual(len(migrated), len(legacy))
+      os.remove(csvfile)
+      # now loaded from binary
+      data = cache.read(csvfile)
+      self.assertEqual(len(data), len(legacy))
+      self.assertEqual(data.GEOGRAPHY_CODE.dtype, "category")
+      for column in cache.SCHEMA:
+        self.assertEqual(data[column].dtype, migrated[column].dtype)
+        self.assertTrue(np.array_equal(np.asarray(data[column]), np.asarray(legacy[column])))
+      # not present
+      self.assertIsNone(cache.read(os.path.join(tmpdir, "missing.csv")))
+    finally:
+      shutil.rmtree(tmpdir)
+
+  def test_compact_dtypes(self):
+    expected = {"GEOGRAPHY_CODE": "category", "PROJECTED_YEAR_NAME": np.uint16, "GENDER": np.uint8, "C_AGE": np.uint8}
+    for data in [self.mye.filter(2011, "E09000001"), self.npp.detail("ppp", utils.EN, [2020]),
+                 self.snpp.filter("S12000033", [2020]), self.snpp.extrapolate(self.npp, "W06000001", [2040, 2050])]:
+      for column in expected:
+        self.assertEqual(data[column].dtype, expected[column])
+      self.assertEqual(data.OBS_VALUE.dtype, np.float64)
+    # the mixed "90"/90 NI ages are normalised
+    self.assertEqual(sorted(self.snpp.filter("N09000001", [2020]).C_AGE.unique()), list(range(0,91)))
+
+    snpp = SNPPData.SNPPData(self.cache_dir, float32=True)
+    data = snpp.filter("W06000001", [2020])
+    self.assertEqual(data.OBS_VALUE.dtype, np.float32)
+    self.assertTrue(np.allclose(data.OBS_VALUE, self.snpp.filter("W06000001", [2020]).OBS_VALUE))
+    dense = SNPPData.SNPPData(self.cache_dir, dense=True, float32=True)
+    self.assertEqual(dense.cubes[utils.WA].values.dtype, np.float32)
+    self.assertEqual(dense.aggregate(["GENDER", "C_AGE"], "W06000001", [2020]).OBS_VALUE.dtype, np.float32)
+    self.assertEqual(NPPData.NPPData(self.cache_dir, float32=True).detail("ppp", utils.EN, [2020]).OBS_VALUE.dtype, np.float32)
+    self.assertEqual(MYEData.MYEData(self.cache_dir, float32=True).filter(2011, "E09000001").OBS_VALUE.dtype, np.float32)
+
+  def test_download(self):
+    _FileHandler.FILES = {"/a.zip": os.urandom(3000000), "/b.xlsx": os.urandom(1000)}
+    server = _Server(("127.0.0.1", 0), _FileHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}".format(server.server_address[1])
+    tmpdir = tempfile.mkdtemp()
+    try:
+      # concurrent
+      a = os.path.join(tmpdir, "a.zip")
+      b = os.path.join(tmpdir, "b.xlsx")
+      download.fetch_all({a: url + "/a.zip", b: url + "/b.xlsx"}, checksums={b: hashlib.sha256(_FileHandler.FILES["/b.xlsx"]).hexdigest()})
+      for (file, path) in [(a, "/a.zip"), (b, "/b.xlsx")]:
+        with open(file, "rb") as fd:
+          self.assertEqual(fd.read(), _FileHandler.FILES[path])
+      # existing files aren't downloaded again
+      _FileHandler.log = []
+      download.fetch(url + "/a.zip", a)
+      self.assertEqual(_FileHandler.log, [])
+      # concurrent requests for the same file download it once
+      os.remove(a)
+      with ThreadPoolExecutor(max_workers=4) as executor:
+        self.assertEqual(list(executor.map(lambda _: download.fetch(url + "/a.zip", a), range(4))), [a] * 4)
+      self.assertEqual(_FileHandler.log, [("/a.zip", None)])
+      _FileHandler.log = []
+
+      # resume a partial download
+      os.remove(a)
+      with open(a + ".part", "wb") as fd:
+        fd.write(_FileHandler.FILES["/a.zip"][:1000000])
+      download.fetch(url + "/a.zip", a, size=3000000)
+      self.assertEqual(_FileHandler.log, [("/a.zip", "bytes=1000000-")])
+      with open(a, "rb") as fd:
+        self.assertEqual(fd.read(), _FileHandler.FILES["/a.zip"])
+      self.assertFalse(os.path.exists(a + ".part"))
+
+      # complete partial download
+      os.rename(a, a + ".part")
+      download.fetch(url + "/a.zip", a)
+      self.assertEqual(os.path.getsize(a), 3000000)
+
+      # server that doesn't support ranges
+      _FileHandler.RANGES = False
+      os.remove(a)
+      with open(a + ".part", "wb") as fd:
+        fd.write(b"junk")
+      download.fetch(url + "/a.zip", a)
+      with open(a, "rb") as fd:
+        self.assertEqual(fd.read(), _FileHandler.FILES["/a.zip"])
+
+      # validation failures
+      os.remove(b)
+      self.assertRaises(ValueError, download.fetch, url + "/b.xlsx", b, size=999)
+      self.assertRaises(ValueError, download.fetch, url + "/b.xlsx", b, sha256="0" * 64)
+      self.assertFalse(os.path.exists(b) or os.path.exists(b + ".part"))
+      self.assertRaises(Exception, download.fetch, url + "/missing.zip", os.path.join(tmpdir, "missing.zip"))
+    finally:
+      _FileHandler.RANGES = True
+      server.shutdown()
+      shutil.rmtree(tmpdir)
+
+  def test_wales_odata(self):
+    server = _Server(("127.0.0.1", 0), _ODataHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/dataset".format(server.server_address[1])
+    sources = SNPPData.SNPPData.SOURCES
+    cache_dir = _test_cache(exclude="snpp_w")
+    try:
+      # pages are requested by offset, and assembled in order
+      _ODataHandler.log = []
+      chunks = SNPPData._read_odata(url + "?$select=Data", len, page_size=100)
+      self.assertEqual(len(chunks), -(-len(_ODataHandler.RECORDS) // _ODataHandler.PAGE_SIZE))
+      self.assertEqual(sum(chunks), len(_ODataHandler.RECORDS))
+      self.assertEqual(sorted(int(q["$skip"][0]) for q in _ODataHandler.log), list(range(0, len(_ODataHandler.RECORDS), _ODataHandler.PAGE_SIZE)))
+      data = pd.concat(SNPPData._read_odata(url + "?$select=Data", pd.DataFrame), ignore_index=True)
+      self.assertEqual(data.to_dict("records"), _ODataHandler.RECORDS)
+
+      # server that doesn't support $inlinecount
+      _ODataHandler.COUNT = False
+      self.assertEqual(sum(SNPPData._read_odata(url + "?$select=Data", len)), len(_ODataHandler.RECORDS))
+      _ODataHandler.COUNT = True
+
+      # load Wales from the stand-in
+      SNPPData.SNPPData.SOURCES = dict(sources, **{utils.WA: ("snpp_w.csv", None, url)})
+      snpp = SNPPData.SNPPData(cache_dir)
+      data = snpp.filter(["W06000001", "W06000002"], [2016, 2017])
+      self.assertEqual(len(data), 2 * 2 * 2 * 91)
+      self.assertEqual(data.C_AGE.dtype, np.uint8)
+      self.assertEqual(sorted(data.C_AGE.unique()), list(range(0,91)))
+      self.assertEqual(data[(data.GEOGRAPHY_CODE == "W06000002") & (data.PROJECTED_YEAR_NAME == 2017) & (data.GENDER == 2) & (data.C_AGE == 90)].OBS_VALUE.values[0], 2017902.0)
+      self.assertTrue(os.path.isdir(cache.path(os.path.join(cache_dir, "snpp_w.csv"))))
+    finally:
+      SNPPData.SNPPData.SOURCES = sources
+      _ODataHandler.COUNT = True
+      server.shutdown()
+      shutil.rmtree(cache_dir)
+
+  def test_scotland_zip(self):
+    cache_dir = _test_cache(exclude="snpp_s")
+    try:
+      # zip laid out as the NRS one, 1 file per year and gender with a row per council area (after the total)
+      codes = ["S12000005", "S12000006", "S12000008"]
+      with zipfile.ZipFile(os.path.join(cache_dir, "snpp_s.zip"), "w") as z:
+        for year in range(2016, 2042):
+          for gender, name in [(1, "Male"), (2, "Female")]:
+            table = pd.DataFrame([[i * 10000 + gender * 1000 + age + (year - 2016) / 100 for age in range(91)] for i in range(3)], columns=[str(a) for a in range(90)] + ["90 and over"])
+            table = pd.concat([table.sum().to_frame().T, table], ignore_index=True)
+            table.insert(0, "All Ages", table.sum(axis=1))
+            table.insert(0, "Code", ["S92000003"] + codes)
+            table.insert(0, "Area", ["Scotland", "A", "B", "C"])
+            z.writestr("CA 1/Population-{}-{}.csv".format(year, name), table.to_csv(index=False))
+
+      data = SNPPData.SNPPData(cache_dir).data[utils.SC]
+      self.assertEqual(len(data), 3 * 26 * 2 * 91)
+      self.assertCountEqual(data.GEOGRAPHY_CODE.unique(), codes)
+      self.assertEqual(sorted(data.C_AGE.unique()), list(range(91)))
+      row = data[(data.GEOGRAPHY_CODE == "S12000008") & (data.PROJECTED_YEAR_NAME == 2041) & (data.GENDER == 1) & (data.C_AGE == 90)]
+      self.assertAlmostEqual(row.OBS_VALUE.values[0], 21090.25)
+    finally:
+      shutil.rmtree(cache_dir)
+
+  def test_nireland_workbook(self):
+    from openpyxl import Workbook
+    cache_dir = _test_cache(exclude="snpp_ni")
+    try:
+      # workbook laid out as the NISRA one, 1 sheet per district
+      workbook = Workbook()
+      workbook.remove(workbook.active)
+      for d, district in enumerate(SNPPData.SNPPData.NI_DISTRICTS):
+        sheet = workbook.create_sheet(district)
+        sheet["A3"] = "N090000{:02d}".format(d + 1)
+        for gender, top in [(1, 5), (2, 100)]:
+          sheet.cell(row=top, column=1, value="Age")
+          for y in range(26):
+            sheet.cell(row=top, column=y + 2, value=2016 + y)
+          for age in range(91):
+            sheet.cell(row=top + 2 + age, column=1, value="90+" if age == 90 else age)
+            for y in range(26):
+              sheet.cell(row=top + 2 + age, column=y + 2, value=100000 * d + 10000 * gender + 100 * age + y)
+      workbook.save(os.path.join(cache_dir, "ni_raw.xlsx"))
+
+      snpp = SNPPData.SNPPData(cache_dir)
+      data = snpp.data[utils.NI]
+      self.assertEqual(len(data), 11 * 2 * 91 * 26)
+      self.assertEqual(data.C_AGE.dtype, np.uint8)
+      row = data[(data.GEOGRAPHY_CODE == "N09000004") & (data.PROJECTED_YEAR_NAME == 2030) & (data.GENDER == 2) & (data.C_AGE == 90)]
+      self.assertEqual(row.OBS_VALUE.values[0], 300000 + 20000 + 9000 + 14)
+      self.assertTrue(os.path.isdir(cache.path(os.path.join(cache_dir, "snpp_ni.csv"))))
+    finally:
+      shutil.rmtree(cache_dir)
+
+  def test_npp_xml(self):
+    rows = list(NPPData._iter_excel_xml(io.BytesIO(_npp_xml(range(2016,2018), 5).encode()), "Population"))
+    self.assertEqual(len(rows), 1 + 2 * 107)
+    self.assertEqual(rows[0], ["Sex", "Age", "2016", "2017"])
+    self.assertEqual(rows[-1], ["2", " 110 and over", "5", "5"])
+
+    data = NPPData._read_npp_xml(io.BytesIO(_npp_xml(range(2016,2018), 5).encode()))
+    self.assertEqual(len(data), 2 * 107 * 2)
+    self.assertCountEqual(data.PROJECTED_YEAR_NAME.unique(), [2016, 2017])
+    self.assertEqual(data.OBS_VALUE.dtype, np.float64)
+    self.assertTrue(np.array_equal(sorted(data.C_AGE.unique()), list(range(0,106)) + [110]))
+    self.assertEqual(data.OBS_VALUE.sum(), 5 * 2 * 107 * 2)
+
+  def test_snpp_variant_cold_cache(self):
+    # countries are processed concurrently against the same NPPData, whose variant isn't yet built
+    cache_dir = _npp_test_cache(["hhh"])
+    try:
+      npp = NPPData.NPPData(cache_dir)
+      builds = []
+      build_variants = npp._NPPData__build_variants
+      def build(*args):
+        builds.append(args)
+        # (widen the window for a concurrent build)
+        time.sleep(0.2)
+        build_variants(*args)
+      npp._NPPData__build_variants = build
+      lads = ["E06000001", "W06000011", "S12000033"]
+      variant = self.snpp.create_variant("hhh", npp, lads, [2016, 2017, 2018])
+      self.assertEqual(len(builds), 1)
+      self.assertCountEqual(variant.GEOGRAPHY_CODE.unique(), lads)
+    finally:
+      shutil.rmtree(cache_dir)
+
+  def test_npp_variant_build(self):
+    cache_dir = _npp_test_cache(["hhh", "lll"])
+    try:
+      npp = NPPData.NPPData(cache_dir)
+      # both variants built in a single pass
+      npp.force_load_variants(["hhh", "lll"])
+      self.assertCountEqual(list(npp.data.keys()), ["ppp", "hhh", "lll"])
+      self.assertEqual(npp.data["hhh"].OBS_VALUE.sum() * 2, npp.data["lll"].OBS_VALUE.sum())
+      data = npp.detail("lll", utils.UK)
+      # 4 countries * 3 years * 2 genders * 91 ages
+      self.assertEqual(len(data), 4 * 3 * 2 * 91)
+      self.assertTrue(np.array_equal(sorted(data.C_AGE.unique()), range(0,91)))
+      self.assertCountEqual(data.GEOGRAPHY_CODE.unique(), utils.CODES.values())
+      # all values are 2, except 90+ which is the sum of 17 age categories
+      self.assertTrue((data[data.C_AGE < 90].OBS_VALUE == 2).all())
+      self.assertTrue((data[data.C_AGE == 90].OBS_VALUE == 2 * 17).all())
+      # cached
+      for variant in ["hhh", "lll"]:
+        self.assertTrue(os.path.isdir(cache.path(os.path.join(cache_dir, "npp_" + variant + ".csv"))))
+    finally:
+      shutil.rmtree(cache_dir)
+
+    # parallel build gives identical results
+    cache_dir = _npp_test_cache(["hhh", "lll"])
+    try:
+      parallel = NPPData.NPPData(cache_dir)
+      parallel.force_load_variants(["hhh", "lll"], workers=2)
+      for variant in ["hhh", "lll"]:
+        self.assertTrue(parallel.data[variant].equals(npp.data[variant]))
+      # no temporary files left behind
+      self.assertEqual([f for f in os.listdir(cache_dir) if f.startswith("tmp")], [])
+    finally:
+      shutil.rmtree(cache_dir)
+
   # test datasets have consistent ranges
   def test_consistency(self):
     self.npp.force_load_variants(["hhh", "ppp", "lll"])
@@ -0,0 +1,70 @@
+"""
+AgeBands - reusable age band definitions for aggregating single year of age data
+"""
+
+from collections import OrderedDict
+import numpy as np
+import ukpopulation.utils as utils
+from ukpopulation.cube import Cube
+
+class AgeBands:
+  """
+  Age band definition, a mapping of band label: ages, or a list of (band label, ages) pairs, e.g.
+    AgeBands([("0-15", range(0,16)), ("16-64", range(16,65)), ("65+", range(65,91))])
+  Bands are labelled in the order given, so on python versions before 3.7 (where dicts are unordered) use an OrderedDict or a list.
+  The definition is compiled once to an (age x band) mapping matrix, so that all the bands are computed in a single matrix
+  product. Bands can overlap, and need not cover every age. Aggregated data has an AGE_BAND column in place of C_AGE
+  """
+
+  # ages are 0-90, the last being 90 and over
+  MAX_AGE = 90
+
+  def __init__(self, bands):
+    bands = OrderedDict(bands)
+    self.labels = np.array(list(bands), dtype=object)
+    self.matrix = np.zeros((AgeBands.MAX_AGE + 1, len(bands)))
+    for band, label in enumerate(bands):
+      ages = [bands[label]] if np.isscalar(bands[label]) else list(bands[label])
+      self.matrix[ages, band] = 1
+
+  @staticmethod
+  def uniform(width):
+    """
+    Returns bands of width years, e.g. "0-4", "5-9", ..., "90+" for width 5
+    """
+    bands = []
+    for lower in range(0, AgeBands.MAX_AGE + 1, width):
+      upper = min(lower + width - 1, AgeBands.MAX_AGE)
+      label = "{}+".format(lower) if upper == AgeBands.MAX_AGE else "{}-{}".format(lower, upper)
+      bands.append((label, range(lower, upper + 1)))
+    return AgeBands(bands)
+
+  def preserved(self, categories):
+    """
+    As utils.check_and_invert, with the (preserved) bands in place of age. Throws ValueError if C_AGE is in categories
+    """
+    if "C_AGE" in ([categories] if isinstance(categories, str) else categories):
+      raise ValueError("C_AGE cannot be aggregated over when aggregating into age bands")
+    return ["AGE_BAND" if category == "C_AGE" else category for category in utils.check_and_invert(categories)]
+
+  def apply(self, values, ages):
+    """
+    Sums the last axis of values, whose category values are ages, into the bands. Returns the summed values and the band labels.
+    Missing values are ignored, but a band is missing if all of its ages are
+    """
+    matrix = self.matrix[np.asarray(ages, dtype=int)]
+    missing = np.isnan(values)
+    banded = np.where(missing, 0, values) @ matrix
+    banded[(~missing) @ matrix == 0] = np.nan
+    return (banded.astype(values.dtype), self.labels)
+
+  def aggregate(self, data, categories):
+    """
+    Aggregates long-format data (with GEOGRAPHY_CODE, PROJECTED_YEAR_NAME, GENDER, C_AGE and OBS_VALUE columns) into the
+    bands, then over categories
+    """
+    return Cube.from_frame(data).aggregate(categories, None, None, None, None, bands=self)
+
+# commonly used bands
+BROAD = AgeBands([("0-15", range(0,16)), ("16-64", range(16,65)), ("65+", range(65,91))])
+FIVE_YEAR = AgeBands.uniform(5)
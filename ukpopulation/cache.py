@@ -0,0 +1,190 @@
+"""
+Columnar binary cache for preprocessed population data
+Each dataset is stored as a directory containing one .npy file per column (and a metadata file), so that loading is
+simply a (memory-mapped) read of each column rather than a parse of CSV text with inferred dtypes
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import contextlib
+import numpy as np
+import pandas as pd
+try:
+  import fcntl
+except ImportError: # not available on windows
+  fcntl = None
+
+# increment when the on-disk format or schema changes (existing caches are then rebuilt/migrated)
+VERSION = 2
+
+# fixed (compact) column dtypes. NB year, gender and age are unsigned so take care with any arithmetic on them
+SCHEMA = {
+  "GEOGRAPHY_CODE": "category",
+  "PROJECTED_YEAR_NAME": "uint16",
+  "GENDER": "uint8",
+  "C_AGE": "uint8",
+  "OBS_VALUE": "float64"
+}
+
+def path(csvfile):
+  """
+  Returns the (versioned) binary cache location corresponding to a CSV cache file
+  """
+  return os.path.splitext(csvfile)[0] + ".v" + str(VERSION)
+
+@contextlib.contextmanager
+def lock(location):
+  """
+  Holds an exclusive inter-process lock on location (a file <location>.lock) for the duration of the context, so that
+  only one process at a time builds or publishes the data at location. The lock is released if the process dies.
+  Where file locking is unavailable (windows) no lock is taken, publication is still atomic but may be duplicated
+  """
+  with open(location + ".lock", "a") as fd:
+    if fcntl is not None:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+def normalise(data, float32=False):
+  """
+  Converts columns to the types given in SCHEMA, or float32 values if float32 is True
+  """
+  for column in data.columns:
+    if not column in SCHEMA:
+      continue
+    dtype = "float32" if column == "OBS_VALUE" and float32 else SCHEMA[column]
+    if data[column].dtype != dtype:
+      # values can be a mixture of strings and numbers, e.g. after a CSV round-trip
+      if data[column].dtype == object and dtype != "category":
+        data[column] = pd.to_numeric(data[column])
+      data[column] = data[column].astype(dtype)
+  return data
+
+def save_arrays(arrays, meta, location):
+  """
+  Saves a dict of numpy arrays (one .npy file each) and json-serialisable metadata to the location (a directory).
+  The data is written to a temporary directory which is then renamed, so that concurrent readers never see a
+  partially-written cache
+  """
+  tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(location)))
+  for name in arrays:
+    np.save(os.path.join(tmpdir, name + ".npy"), arrays[name])
+  meta = dict(meta, version=VERSION)
+  with open(os.path.join(tmpdir, "meta.json"), "w") as fd:
+    json.dump(meta, fd)
+
+  try:
+    os.rename(tmpdir, location)
+  except OSError:
+    # another process got there first
+    shutil.rmtree(tmpdir)
+
+def load_arrays(location, mmap=True):
+  """
+  Loads the arrays and metadata saved by save_arrays, memory-mapped (read-only) by default.
+  Returns None if not present (or an incompatible version)
+  """
+  metafile = os.path.join(location, "meta.json")
+  if not os.path.isfile(metafile):
+    return None
+  with open(metafile) as fd:
+    meta = json.load(fd)
+  if meta["version"] != VERSION:
+    return None
+
+  mode = "r" if mmap else None
+  arrays = {file[:-4]: np.load(os.path.join(location, file), mmap_mode=mode) for file in os.listdir(location) if file.endswith(".npy")}
+  return (arrays, meta)
+
+def save(data, location, source=None):
+  """
+  Saves a dataframe to the binary cache, recording the source (see read) it was created from, if any
+  """
+  data = normalise(data.reset_index(drop=True))
+  arrays = {}
+  columns = []
+  for column in data.columns:
+    if isinstance(data[column].dtype, pd.CategoricalDtype):
+      arrays[column + ".codes"] = data[column].cat.codes.values
+      arrays[column + ".categories"] = np.array(data[column].cat.categories, dtype=str)
+      columns.append({"name": column, "dtype": "category"})
+    else:
+      arrays[column] = data[column].values
+      columns.append({"name": column, "dtype": str(data[column].dtype)})
+  save_arrays(arrays, { "rows": len(data), "columns": columns, "source": source }, location)
+  return data
+
+def load(location, mmap=True):
+  """
+  Loads a dataframe from the binary cache, or returns None if not present (or an incompatible version)
+  """
+  cached = load_arrays(location, mmap)
+  if cached is None:
+    return None
+  return _frame(*cached)
+
+def _frame(arrays, meta):
+  """
+  Constructs the dataframe from the arrays and metadata saved by save
+  """
+  columns = {}
+  for column in meta["columns"]:
+    name = column["name"]
+    if column["dtype"] == "category":
+      columns[name] = pd.Categorical.from_codes(arrays[name + ".codes"], arrays[name + ".categories"])
+    else:
+      columns[name] = arrays[name]
+  return pd.DataFrame(columns)
+
+def read(csvfile):
+  """
+  Returns cached data from the binary cache corresponding to csvfile. If the (legacy) CSV cache exists and the binary
+  cache was not converted from it (i.e. it is missing, or the CSV has since changed) the CSV is converted to the binary
+  format, replacing any previous binary cache. Returns None if neither exists
+  """
+  location = path(csvfile)
+  source = _source(csvfile)
+  cached = load_arrays(location)
+  if cached is not None and (source is None or cached[1].get("source") == source):
+    return _frame(*cached)
+  if source is None:
+    return None
+
+  with lock(location):
+    # another process may have converted it while we waited
+    cached = load_arrays(location)
+    if cached is not None and cached[1].get("source") == source:
+      return _frame(*cached)
+    print("Migrating {} to {}".format(csvfile, location))
+    # (including the stale cache of the current version)
+    _remove(csvfile, VERSION + 1)
+    return save(pd.read_csv(csvfile), location, source)
+
+def write(data, csvfile):
+  """
+  Saves data to the binary cache corresponding to csvfile (removing any caches of previous versions), returning the
+  data with normalised column types
+  """
+  _remove(csvfile, VERSION)
+  return save(data, path(csvfile))
+
+def _source(csvfile):
+  """
+  Returns the size and modification time of csvfile (recorded in the binary cache converted from it), or None if not present
+  """
+  if not os.path.isfile(csvfile):
+    return None
+  stat = os.stat(csvfile)
+  return { "size": stat.st_size, "mtime": stat.st_mtime_ns }
+
+def _remove(csvfile, version):
+  """
+  Removes the binary caches corresponding to csvfile of versions prior to version
+  """
+  for v in range(1, version):
+    shutil.rmtree(os.path.splitext(csvfile)[0] + ".v" + str(v), ignore_errors=True)
@@ -0,0 +1,251 @@
+"""
+Cube - dense array representation of population data by geography, year, gender and age
+"""
+
+import functools
+import numpy as np
+import pandas as pd
+import ukpopulation.utils as utils
+import ukpopulation.cache as cache
+
+class Cube:
+  """
+  Population data held as a dense (float64, or float32) array indexed [geography, year, gender, age], with lookup tables
+  mapping category values to array indices. Subsetting is then an array slice rather than a boolean mask
+  over every row, and aggregation is a reduction over array axes.
+  Missing values are stored as NaN and are omitted from any output.
+  """
+
+  # column names corresponding to each array axis (in order)
+  AXES = ["GEOGRAPHY_CODE", "PROJECTED_YEAR_NAME", "GENDER", "C_AGE"]
+
+  def __init__(self, values, geogs, years, genders, ages):
+    self.values = values
+    # category values for each axis, sorted
+    self.labels = [np.asarray(geogs), np.asarray(years), np.asarray(genders), np.asarray(ages)]
+    # category value -> array index lookups
+    self.index = [{v: i for i, v in enumerate(l)} for l in self.labels]
+    assert self.values.shape == tuple(len(l) for l in self.labels)
+    # whether there are any missing values (determined on first use)
+    self.__complete = None
+
+  @staticmethod
+  def from_frame(data):
+    """
+    Constructs a cube from long-format data with (at least) the columns GEOGRAPHY_CODE, PROJECTED_YEAR_NAME, GENDER, C_AGE and OBS_VALUE
+    """
+    labels = []
+    indices = []
+    for axis in Cube.AXES:
+      values = np.asarray(data[axis])
+      # year, gender and age categories are integers (though they may not be stored as such)
+      if axis != "GEOGRAPHY_CODE":
+        values = values.astype(int)
+      (l, i) = np.unique(values, return_inverse=True)
+      labels.append(l)
+      indices.append(i)
+
+    # preserve single precision values
+    dtype = np.float32 if data.OBS_VALUE.dtype == np.float32 else np.float64
+    values = np.full([len(l) for l in labels], np.nan, dtype=dtype)
+    values[tuple(indices)] = data.OBS_VALUE.values
+    return Cube(values, *labels)
+
+  @staticmethod
+  def stack(cubes):
+    """
+    Combines cubes containing different geographies into a single cube, whose other categories are the union of those of each cube
+    """
+    geogs = np.concatenate([cube.labels[0] for cube in cubes])
+    labels = [functools.reduce(np.union1d, [cube.labels[axis] for cube in cubes]) for axis in range(1, len(Cube.AXES))]
+    values = np.full([len(geogs)] + [len(l) for l in labels], np.nan, dtype=np.result_type(*[cube.values for cube in cubes]))
+    offset = 0
+    for cube in cubes:
+      idx = [np.arange(offset, offset + len(cube.labels[0]))] + [np.searchsorted(l, cube.labels[axis + 1]) for axis, l in enumerate(labels)]
+      values[np.ix_(*idx)] = cube.values
+      offset += len(cube.labels[0])
+    # geographies are sorted
+    order = np.argsort(geogs, kind="stable")
+    return Cube(values[order], geogs[order], *labels)
+
+  def rollup(self, groups):
+    """
+    Returns a cube of the totals for groups, a dict of group code: list of geography codes (which can overlap), computed
+    as the product of a (group x geography) membership matrix with the array. Geography codes not in the cube are ignored,
+    and a total is missing unless all of its geographies have a value
+    """
+    codes = sorted(groups)
+    membership = np.zeros((len(codes), len(self.labels[0])))
+    for i, code in enumerate(codes):
+      membership[i, self.lookup(0, groups[code])] = 1
+    missing = np.isnan(self.values)
+    values = np.tensordot(membership, np.where(missing, 0, self.values), axes=1)
+    # incomplete (or empty) groups
+    values[np.tensordot(membership, missing, axes=1) > 0] = np.nan
+    values[membership.sum(axis=1) == 0] = np.nan
+    return Cube(values.astype(self.values.dtype), codes, *self.labels[1:])
+
+  def save(self, location):
+    """
+    Saves the cube (see cache.save_arrays)
+    """
+    arrays = {"values": self.values}
+    for axis, name in enumerate(Cube.AXES):
+      arrays[name] = self.labels[axis].astype(str) if name == "GEOGRAPHY_CODE" else self.labels[axis]
+    cache.save_arrays(arrays, {}, location)
+
+  @staticmethod
+  def load(location, mmap=True):
+    """
+    Loads a cube saved by save (the values memory-mapped read-only by default), or returns None if not present
+    """
+    cached = cache.load_arrays(location, mmap)
+    if cached is None:
+      return None
+    (arrays, _) = cached
+    return Cube(arrays["values"], *[np.asarray(arrays[name]) for name in Cube.AXES])
+
+  @staticmethod
+  def shared(location, build):
+    """
+    Returns the cube saved at location, memory-mapped read-only so that the (page cache) memory is shared by every
+    process attached to it. If not present the cube is first constructed by calling build, and saved. Only one process
+    builds it, any others wait for it to be published
+    """
+    cube = Cube.load(location)
+    if cube is None:
+      with cache.lock(location):
+        # another process may have published it while we waited
+        cube = Cube.load(location)
+        if cube is None:
+          build().save(location)
+          cube = Cube.load(location)
+    return cube
+
+  def lookup(self, axis, keys):
+    """
+    Returns the (sorted) array indices along axis for the supplied category values.
+    Values not present are silently ignored (consistent with isin filtering)
+    """
+    if keys is None:
+      return np.arange(len(self.labels[axis]))
+    if np.isscalar(keys):
+      keys = [keys]
+    return np.array(sorted({self.index[axis][k] for k in keys if k in self.index[axis]}), dtype=int)
+
+  def slice(self, geog_codes, years=None, ages=range(0,91), genders=[1,2]):
+    """
+    Returns the subset of the array corresponding to the supplied categories, and the category values along each axis
+    """
+    idx = [self.lookup(axis, keys) for axis, keys in enumerate([geog_codes, years, genders, ages])]
+    return (self.values[np.ix_(*idx)], [self.labels[axis][i] for axis, i in enumerate(idx)])
+
+  def filter(self, geog_codes, years=None, ages=range(0,91), genders=[1,2]):
+    """
+    Equivalent to filtering the long-format data on each category, rows are ordered by geography, year, gender then age
+    """
+    (values, labels) = self.slice(geog_codes, years, ages, genders)
+    return Cube.frame(values, labels, Cube.AXES)
+
+  def complete(self):
+    """
+    Returns True if there are no missing values
+    """
+    if self.__complete is None:
+      # (a geography at a time, to avoid a full size temporary)
+      self.__complete = not any(np.isnan(v).any() for v in self.values)
+    return self.__complete
+
+  def aggregate(self, categories, geog_codes, years=None, ages=range(0,91), genders=[1,2], bands=None):
+    """
+    Equivalent to filtering then summing OBS_VALUE over categories, with rows in the same order as a groupby.
+    If bands (see agebands.AgeBands) is given ages are first summed into the bands, which are preserved (as AGE_BAND)
+    """
+    axes = list(Cube.AXES)
+    if bands is None:
+      preserved = utils.check_and_invert(categories)
+    else:
+      preserved = bands.preserved(categories)
+      axes[3] = "AGE_BAND"
+
+    idx = [self.lookup(axis, keys) for axis, keys in enumerate([geog_codes, years, genders, ages])]
+    if self.complete() and all(len(i) for i in idx):
+      (values, labels) = self.__contract(idx, [name in preserved for name in axes], bands)
+    else:
+      (values, labels) = self.__reduce(idx, [name in preserved for name in axes], bands)
+
+    # transpose remaining axes into groupby order
+    remaining = [name for name in axes if name in preserved]
+    order = [remaining.index(name) for name in preserved]
+    labels = [labels[axes.index(name)] for name in preserved]
+    data = Cube.frame(values.transpose(order), labels, preserved)
+    if bands is not None and "AGE_BAND" in preserved:
+      # (so that groupby preserves the band order)
+      data["AGE_BAND"] = pd.Categorical(data.AGE_BAND, categories=bands.labels, ordered=True)
+    return data
+
+  def __contract(self, idx, keep, bands):
+    """
+    Aggregates complete data directly from the stored array: each summed axis is contracted with a (0/1) selection vector
+    and the age axis with the band matrix (if any), in a single pass over a view of the array. Only the result (at most the
+    extent of the selected preserved categories) is allocated, the selected subset is never copied
+    """
+    # the (view) of the array bounding the selection
+    bounds = tuple(slice(i[0], i[-1] + 1) for i in idx)
+    view = self.values[bounds]
+    local = [i - i[0] for i in idx]
+
+    operands = [view, list(range(len(idx)))]
+    output = []
+    for axis, selected in enumerate(local):
+      if axis == 3 and bands is not None:
+        matrix = np.zeros((view.shape[axis], len(bands.labels)), dtype=view.dtype)
+        matrix[selected] = bands.matrix[self.labels[axis][idx[axis]]]
+        operands += [matrix, [axis, len(idx)]]
+        output.append(len(idx))
+      elif keep[axis]:
+        output.append(axis)
+      else:
+        weights = np.zeros(view.shape[axis], dtype=view.dtype)
+        weights[selected] = 1
+        operands += [weights, [axis]]
+    values = np.einsum(*operands, output)
+
+    # now select the preserved categories from the (reduced) result
+    labels = [self.labels[axis][i] for axis, i in enumerate(idx)]
+    select = [local[axis] for axis in range(len(idx)) if keep[axis] and not (axis == 3 and bands is not None)]
+    if any(len(s) < n for s, n in zip(select, values.shape)):
+      values = values[np.ix_(*(select + [np.arange(n) for n in values.shape[len(select):]]))]
+    if bands is not None:
+      # bands containing none of the selected ages
+      values[..., matrix.sum(axis=0) == 0] = np.nan
+      labels[3] = bands.labels
+    return (values, labels)
+
+  def __reduce(self, idx, keep, bands):
+    """
+    Aggregates (possibly incomplete) data by slicing then summing the array, ignoring missing values
+    """
+    values = self.values[np.ix_(*idx)]
+    labels = [self.labels[axis][i] for axis, i in enumerate(idx)]
+    if bands is not None:
+      (values, labels[3]) = bands.apply(values, labels[3])
+
+    summed = tuple(axis for axis in range(len(idx)) if not keep[axis])
+    # exclude any output category for which there is no data at all
+    present = (~np.isnan(values)).any(axis=summed)
+    values = np.nansum(values, axis=summed)
+    values[~present] = np.nan
+    return (values, labels)
+
+  @staticmethod
+  def frame(values, labels, columns):
+    """
+    Converts an array with category values labels along each axis into a long-format dataframe with the given column names,
+    omitting missing values. Column types are as per cache.normalise
+    """
+    grid = np.meshgrid(*labels, indexing="ij")
+    data = pd.DataFrame({column: g.ravel() for column, g in zip(columns, grid)})
+    data["OBS_VALUE"] = values.ravel()
+    data = data[~np.isnan(data.OBS_VALUE.values)].reset_index(drop=True)
+    return cache.normalise(data, values.dtype == np.float32)
@@ -0,0 +1,117 @@
+"""
+Download manager for raw source files: concurrent, resumable and validated downloads over a pooled HTTP session
+"""
+
+import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import ukpopulation.cache as cache
+
+# streaming chunk size (bytes)
+CHUNK_SIZE = 1024 * 1024
+# default number of concurrent downloads (and pooled connections)
+MAX_WORKERS = 4
+# seconds to wait for the server to respond
+TIMEOUT = 60
+
+_session = None
+_session_lock = threading.Lock()
+# per-filename locks, so that concurrent requests for the same file download it once
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+
+def session():
+  """
+  Returns the (shared, thread-safe) HTTP session, whose connections are pooled and reused across downloads
+  """
+  global _session
+  with _session_lock:
+    if _session is None:
+      _session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS, max_retries=3)
+      _session.mount("http://", adapter)
+      _session.mount("https://", adapter)
+  return _session
+
+def fetch(url, filename, size=None, sha256=None):
+  """
+  Downloads url to filename, unless filename already exists. The data is streamed to a partial file which is
+  renamed once complete, and an existing partial file (from an interrupted download) is resumed with an HTTP range request.
+  Raises IOError if the transfer is incomplete (the partial file is kept so that it can be resumed), or ValueError if the
+  file doesn't match the expected size or sha256 checksum (if given).
+  Concurrent calls for the same filename (from any thread or process) are serialised, the first downloads the file and
+  the others then use it
+  """
+  with _file_locks_lock:
+    lock = _file_locks.setdefault(os.path.abspath(filename), threading.Lock())
+  with lock, cache.lock(filename):
+    return _fetch(url, filename, size, sha256)
+
+def _fetch(url, filename, size, sha256):
+  """
+  Downloads url to filename (see fetch), which must not be called concurrently for the same filename
+  """
+  if os.path.isfile(filename):
+    print("using " + filename)
+    return filename
+
+  partial = filename + ".part"
+  offset = os.path.getsize(partial) if os.path.isfile(partial) else 0
+  # (compressed transfer would invalidate the length and range offsets)
+  headers = {"Accept-Encoding": "identity"}
+  if offset:
+    headers["Range"] = "bytes={}-".format(offset)
+
+  with session().get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+    # 416 means there is nothing beyond offset, i.e. the partial file is already complete
+    if not (offset and response.status_code == 416):
+      response.raise_for_status()
+      # the server may not support ranges, in which case we get the whole file
+      if response.status_code != 206:
+        offset = 0
+      length = response.headers.get("Content-Length")
+      expected = offset + int(length) if length is not None else None
+
+      print("downloading " + filename + (" (resuming at {} bytes)".format(offset) if offset else ""))
+      with open(partial, "ab" if offset else "wb") as fd:
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+          fd.write(chunk)
+
+      if expected is not None and os.path.getsize(partial) != expected:
+        raise IOError("incomplete download of {}: {} of {} bytes".format(url, os.path.getsize(partial), expected))
+
+  _validate(partial, url, size, sha256)
+  os.replace(partial, filename)
+  print("downloaded " + filename)
+  return filename
+
+def fetch_all(sources, workers=MAX_WORKERS, checksums={}):
+  """
+  Downloads sources, a dict of filename: url, concurrently using a pool of (at most) workers threads.
+  checksums is an optional dict of filename: sha256. Returns the filenames, raising the first error encountered (if any)
+  """
+  if not sources:
+    return []
+  with ThreadPoolExecutor(max_workers=min(workers, len(sources))) as executor:
+    futures = [executor.submit(fetch, sources[filename], filename, sha256=checksums.get(filename)) for filename in sources]
+    return [future.result() for future in futures]
+
+def _validate(filename, url, size, sha256):
+  """
+  Checks the size and/or checksum of a downloaded file, removing it if invalid
+  """
+  error = None
+  if size is not None and os.path.getsize(filename) != size:
+    error = "size of {} is {} bytes, expected {}".format(url, os.path.getsize(filename), size)
+  elif sha256 is not None:
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fd:
+      for chunk in iter(lambda: fd.read(CHUNK_SIZE), b""):
+        digest.update(chunk)
+    if digest.hexdigest() != sha256.lower():
+      error = "sha256 of {} is {}, expected {}".format(url, digest.hexdigest(), sha256)
+  if error is not None:
+    os.remove(filename)
+    raise ValueError(error)
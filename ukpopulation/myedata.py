@@ -2,9 +2,11 @@
 MYEData - wrapper around Mid-Year Estimate data by LAD, SYoA and gender
 """
 
-import pandas as pd
 import ukcensusapi.Nomisweb as Api
 import ukpopulation.utils as utils
+import ukpopulation.cache as cache
+import ukpopulation.rollup as rollup
+from ukpopulation.cube import Cube
 
 class MYEData:
   """
@@ -17,14 +19,34 @@ class MYEData:
   MIN_YEAR = 1991
   MAX_YEAR = 2016
 
-  def __init__(self, cache_dir=None):
+  # each year is ~71000 rows (391 LADs * 91 ages * 2 genders), and nomisweb queries are limited to 1000000 rows
+  YEARS_PER_QUERY = 14
+
+  def __init__(self, cache_dir=None, float32=False):
+    """
+    Loaded data has compact column types (see cache.normalise), and if float32 is True the values are held in single precision
+    """
     if cache_dir is None:
       cache_dir = utils.default_cache_dir()
     self.cache_dir = cache_dir
     self.data_api = Api.Nomisweb(self.cache_dir) 
+    self.float32 = float32
 
-    # store as a dictionary keyed by year (lazy retrieval)
-    self.data = {}
+    # dataframes keyed by year (lazy retrieval)
+    self.years = {}
+    # all the loaded years in a single dataframe (constructed when needed)
+    self.__data = None
+    # totals for groups of LADs (Cubes), keyed by grouping and year
+    self.rollups = {}
+
+  @property
+  def data(self):
+    """
+    All the loaded years in a single dataframe indexed by year
+    """
+    if self.__data is None:
+      self.__data = self.__years(sorted(self.years)).set_index("PROJECTED_YEAR_NAME")
+    return self.__data
 
   def min_year(self):
     """
@@ -38,7 +60,11 @@ class MYEData:
     """
     return MYEData.MAX_YEAR
 
-  # TODO functionality for easy aggregration to E/W/EW/S/GB/NI/UK
+  def preload(self, years=None):
+    """
+    Loads the data for the given years (default all years), in as few queries as possible
+    """
+    self.__fetch_data(utils.trim_range(years, MYEData.MIN_YEAR, MYEData.MAX_YEAR))
 
   def filter(self, years, geogs, ages=range(0,91), genders=[1,2]):
     """
@@ -54,58 +80,137 @@ class MYEData:
     if isinstance(genders, int):
       genders = [genders]
 
-    result = pd.DataFrame()
-
-    for year in years:
-
-      # ensure the data is loaded
-      self.__fetch_data(year)
-
-      ## ensure we return a copy!
-      part = self.data[year][(self.data[year].GEOGRAPHY_CODE.isin(geogs)) &
-                             (self.data[year].C_AGE.isin(ages)) &
-                             (self.data[year].GENDER.isin(genders))].copy()
-      part["PROJECTED_YEAR_NAME"] = year
-      result = result.append(part)
+    # ensure the data is loaded
+    self.__fetch_data(years)
 
-    return result.reset_index(drop=True)
+    # filter each year
+    result = utils.Collector()
+    for year in sorted(set(years)):
+      data = self.years[year]
+      result.add(data[(data.GEOGRAPHY_CODE.isin(geogs)) &
+                      (data.C_AGE.isin(ages)) &
+                      (data.GENDER.isin(genders))])
 
-  def aggregate(self, years, geog_codes, categories, ages=range(0,91), genders=[1,2]):
+    # (the geography categories may differ)
+    return utils.remove_unused_categories(cache.normalise(result.result(), self.float32))
 
-    data = self.filter(years, geog_codes, ages, genders)
+  def aggregate(self, years, geog_codes, categories, ages=range(0,91), genders=[1,2], bands=None):
+    """
+    Get MYE data aggregated over categories. If bands (see agebands.AgeBands) is given, ages are summed into the bands,
+    which are preserved (as AGE_BAND)
+    """
 
-    # invert categories (they're the ones to aggregate, not preserve)
-    return data.groupby(utils.check_and_invert(categories))["OBS_VALUE"].sum().reset_index()
+    if bands is not None:
+      return bands.aggregate(self.filter(years, geog_codes, ages, genders), categories)
 
-  def __fetch_data(self, year):
+    # ensure array inputs
+    if isinstance(years, int):
+      years = [years]
+    if isinstance(geog_codes, str):
+      geog_codes = [geog_codes]
+    if isinstance(ages, int):
+      ages = [ages]
+    if isinstance(genders, int):
+      genders = [genders]
+    self.__fetch_data(years)
+
+    # filter and aggregate each year in one pass, without copying the subset
+    subset = {"GEOGRAPHY_CODE": geog_codes, "C_AGE": ages, "GENDER": genders}
+    result = utils.Collector()
+    for year in sorted(set(years)):
+      result.add(utils.aggregate(self.years[year], categories, subset))
+    if len(result) == 1:
+      return cache.normalise(result.chunks[0], self.float32)
+    # (years are never aggregated, so this only restores the groupby order)
+    return cache.normalise(utils.aggregate(cache.normalise(result.result()), categories), self.float32)
+
+  def rollup(self, years, groups=None, ages=range(0,91), genders=[1,2]):
+    """
+    Returns totals for groups of LADs, by default E/W/S/NI/EW/GB/UK (see rollup.rollup). The totals for all genders and
+    ages are computed once per grouping and year, then filtered
+    """
+    if isinstance(years, int):
+      years = [years]
+    if isinstance(ages, int):
+      ages = [ages]
+    if isinstance(genders, int):
+      genders = [genders]
+    self.__fetch_data(years)
+
+    key = None if groups is None else tuple(sorted((code, tuple(groups[code])) for code in groups))
+    result = utils.Collector()
+    for year in sorted(set(years)):
+      if not (key, year) in self.rollups:
+        cube = Cube.from_frame(self.years[year])
+        self.rollups[(key, year)] = cube.rollup(rollup.national_groups(cube.labels[0]) if groups is None else groups)
+      result.add(self.rollups[(key, year)].filter(None, None, ages, genders))
+    return cache.normalise(result.result(), self.float32)
+
+  def __fetch_data(self, years):
     """
-    Gets Mid-year population estimate data for a given year
+    Gets Mid-year population estimate data for the given years (those not already loaded)
     Data is by single year of age by gender by local authority
+    As many years as possible are fetched in each query
     """
+    for year in years:
+      if year < MYEData.MIN_YEAR or year > MYEData.MAX_YEAR:
+        raise ValueError("{} is outside the available years for MYE data ({}-{})".format(year, MYEData.MIN_YEAR, MYEData.MAX_YEAR))
+
     # if data already loaded return 
-    if year in self.data:
+    missing = sorted(set(years) - set(self.years))
+    if not missing:
       return
 
     table_internal = "NM_2002_1" # 2016-based MYE
-    query_params = {
-      "gender": "1,2",
-      "c_age": "101...191",
-      "MEASURES": "20100",
-      "select": "geography_code,gender,c_age,obs_value",
-      "geography": "1879048193...1879048573,1879048583,1879048574...1879048582"
-    }
-
-    if year < MYEData.MIN_YEAR or year > MYEData.MAX_YEAR:
-      raise ValueError("{} is outside the available years for MYE data ({}-{})".format(year, MIN_YEAR, MAX_YEAR))
-
-    query_params["date"] = "latest"
-    if year < MYEData.MAX_YEAR:
-      query_params["date"] += "MINUS" + str(2016-year)
-
-    self.data[year] = self.data_api.get_data(table_internal, query_params)
 
-    # renumber age so that 0 means [0,1)
-    self.data[year].C_AGE -= 101
-
-    return self.data[year]
+    # (previously loaded years are kept as they are)
+    for i in range(0, len(missing), MYEData.YEARS_PER_QUERY):
+      chunk = missing[i:i + MYEData.YEARS_PER_QUERY]
+      query_params = {
+        "gender": "1,2",
+        "c_age": "101...191",
+        "MEASURES": "20100",
+        "select": "geography_code,gender,c_age,obs_value",
+        "geography": "1879048193...1879048573,1879048583,1879048574...1879048582"
+      }
+      # multiple years need the date in the output
+      if len(chunk) > 1:
+        query_params["select"] = "date_name," + query_params["select"]
+
+      query_params["date"] = ",".join(MYEData.__date(year) for year in chunk)
+
+      data = self.data_api.get_data(table_internal, query_params)
+
+      if len(chunk) > 1:
+        data["PROJECTED_YEAR_NAME"] = data.DATE_NAME.astype(str).str[-4:].astype(int)
+        data = data.drop("DATE_NAME", axis=1)
+      else:
+        data["PROJECTED_YEAR_NAME"] = chunk[0]
+
+      # renumber age so that 0 means [0,1)
+      data.C_AGE -= 101
+
+      data = cache.normalise(data[["GEOGRAPHY_CODE", "GENDER", "C_AGE", "OBS_VALUE", "PROJECTED_YEAR_NAME"]], self.float32)
+      by_year = {int(year): year_data.reset_index(drop=True) for year, year_data in data.groupby("PROJECTED_YEAR_NAME", sort=False)}
+      for year in chunk:
+        self.years[year] = by_year.get(year, data.iloc[:0])
+    self.__data = None
+
+  def __years(self, years):
+    """
+    Returns the data for (loaded) years in a single dataframe
+    """
+    result = utils.Collector()
+    for year in years:
+      result.add(self.years[year])
+    # (the geography categories may differ)
+    return utils.remove_unused_categories(cache.normalise(result.result(), self.float32))
 
+  @staticmethod
+  def __date(year):
+    """
+    Returns the nomisweb date parameter for the given year
+    """
+    if year < MYEData.MAX_YEAR:
+      return "latestMINUS" + str(MYEData.MAX_YEAR - year)
+    return "latest"
@@ -1,29 +1,99 @@
 
 import os.path
-import requests
 import zipfile
 import time
+import collections
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 from openpyxl import load_workbook
 import ukcensusapi.Nomisweb as Api
-from bs4 import BeautifulSoup
 import ukpopulation.utils as utils
+import ukpopulation.cache as cache
+import ukpopulation.download as download
+from ukpopulation.cube import Cube
 
-def _read_excel_xml(path, sheet_name):
-  file = open(path).read()
-  soup = BeautifulSoup(file,'xml')
-  worksheet = []
-  for sheet in soup.findAll('Worksheet'): 
-    if sheet["ss:Name"] == sheet_name:
-      for row in sheet.findAll('Row'):
-        row_as_list = []
-        for cell in row.findAll('Cell'):
-          data = cell.find('Data')
-          if data:
-              row_as_list.append(data.text)
-        worksheet.append(row_as_list)
-  return worksheet
+# SpreadsheetML (Excel 2003 XML) namespace
+_SS = "{urn:schemas-microsoft-com:office:spreadsheet}"
+
+def _iter_excel_xml(source, sheet_name):
+  """
+  Incrementally parses a SpreadsheetML file (a path or file-like object, e.g. a zip member), yielding each row of the
+  named worksheet as a list of cell values (strings). Parsed rows are removed from the tree so memory use does not grow
+  with file size
+  """
+  in_sheet = False
+  table = None
+  for event, elem in ET.iterparse(source, events=("start", "end")):
+    if event == "start":
+      if elem.tag == _SS + "Worksheet":
+        in_sheet = elem.get(_SS + "Name") == sheet_name
+      elif elem.tag == _SS + "Table":
+        table = elem
+    elif elem.tag == _SS + "Row":
+      if in_sheet:
+        yield [data.text for data in elem.iter(_SS + "Data")]
+      # (clearing alone would leave an empty element per row attached to the table)
+      elem.clear()
+      if table is not None:
+        table.remove(elem)
+    elif elem.tag == _SS + "Worksheet":
+      if in_sheet:
+        return
+      elem.clear()
+
+def _read_npp_xml(source):
+  """
+  Reads the Population worksheet of an NPP variant file, returning a dataframe with (numeric) columns
+  GENDER, C_AGE, PROJECTED_YEAR_NAME and OBS_VALUE. Age bands (e.g. "105 - 109", "110 and over") take their lower bound
+  """
+  rows = _iter_excel_xml(source, "Population")
+  # header is Sex, Age, then the years
+  years = [int(year) for year in next(rows)[2:]]
+  genders = []
+  ages = []
+  values = []
+  for row in rows:
+    genders.append(int(row[0]))
+    ages.append(int(row[1].split()[0]))
+    values.append(np.array(row[2:], dtype=float))
+
+  df = pd.DataFrame(data=np.vstack(values), columns=years,
+                    index=pd.MultiIndex.from_arrays([genders, ages])).stack().reset_index()
+  df.columns = ["GENDER", "C_AGE", "PROJECTED_YEAR_NAME", "OBS_VALUE"]
+  return df
+
+def _load_variant_xml(z, cache_dir, country, variant_name):
+  """
+  Converts a single country/variant file from the (open) country zip z into the standard format, aggregating ages 90+
+  """
+  # read directly from the zip unless already extracted
+  print("Reading " + country + "_" + variant_name)
+  vxml = country + "_" + variant_name + "_opendata2016.xml"
+  start = time.time()
+  if os.path.isfile(cache_dir + "/" + vxml):
+    df = _read_npp_xml(cache_dir + "/" + vxml)
+  else:
+    with z.open(vxml) as source:
+      df = _read_npp_xml(source)
+  print("read xml in " + str(time.time() - start))
+
+  # aggregate ages 90 and over
+  df.C_AGE = np.minimum(df.C_AGE.values, 90)
+  df = df.groupby(["GENDER", "C_AGE", "PROJECTED_YEAR_NAME"])["OBS_VALUE"].sum().reset_index()
+
+  # add the country code
+  df["GEOGRAPHY_CODE"] = utils.CODES[country]
+  return df
+
+def _load_variant_zip(raw_zip, cache_dir, country, variant_name):
+  """
+  As _load_variant_xml, but opening the zip itself (for use in a worker process)
+  """
+  with zipfile.ZipFile(raw_zip) as z:
+    return _load_variant_xml(z, cache_dir, country, variant_name)
 
 class NPPData:
   """
@@ -58,16 +128,36 @@ class NPPData:
   # No change 	cnp 				
   # Long term balanced net migration 	ppb 	
 
-  def __init__(self, cache_dir = None):
+  # number of detail queries to remember
+  DETAIL_CACHE_SIZE = 16
+
+  def __init__(self, cache_dir = None, persist_ratios=False, float32=False, shared=False):
+    """
+    If persist_ratios is True, ratio tables (see year_ratios and variant_ratios) are also saved to (and reloaded from) cache_dir.
+    If shared is True the variant cubes and ratio tables are published to cache_dir by the first process to need them
+    and memory-mapped read-only by every process, so that any number of workers share a single copy of the data.
+    Loaded data has compact column types (see cache.normalise), and if float32 is True the values are held in single precision
+    """
     if cache_dir is None:
       cache_dir = utils.default_cache_dir()
     self.cache_dir = cache_dir
     self.data_api = Api.Nomisweb(self.cache_dir) 
     # map of pandas dataframes keyed by variant code
     self.data = {}
+    # dense [geography, year, gender, age] representation of each variant, keyed by variant code
+    self.cubes = {}
+    # memo of recent detail queries
+    self.details = collections.OrderedDict()
+    # serialises loading (and memoisation) so that concurrent queries don't load the same data more than once
+    self.lock = threading.RLock()
+    # ratio tables (Cubes) keyed by variant code and reference (a year or "ppp")
+    self.ratios = {}
+    self.persist_ratios = persist_ratios
+    self.float32 = float32
+    self.shared = shared
 
     # load principal aggressively...
-    self.data["ppp"] = self.__download_ppp()
+    self.data["ppp"] = cache.normalise(self.__download_ppp(), self.float32)
 
     # ...and variants lazily
     #self.__download_variants()
@@ -76,13 +166,13 @@ class NPPData:
     """
     Returns the first year in the projection
     """
-    return min(self.data["ppp"].PROJECTED_YEAR_NAME.unique())
+    return int(self.data["ppp"].PROJECTED_YEAR_NAME.min())
 
   def max_year(self):
     """
     Returns the final year in the projection
     """
-    return max(self.data["ppp"].PROJECTED_YEAR_NAME.unique())
+    return int(self.data["ppp"].PROJECTED_YEAR_NAME.max())
 
 
   def detail(self, variant_name, geog, years=None, ages=range(0,91), genders=[1,2]):
@@ -94,66 +184,126 @@ class NPPData:
     # make years a valid range (this *silently* removes invalid years)
     years = utils.trim_range(years, self.min_year(), self.max_year())
 
-    if not variant_name in self.data:
-      # is it a standard variant
-      if variant_name in NPPData.VARIANTS:
-        self.__load_variant(variant_name)
-      else:
-        raise RuntimeError("Invalid variant name / custom variants are not yet implemented")
-
     # apply filters
     if isinstance(geog, str):
       geog = [geog]
-    geog_codes = [utils.CODES[g] for g in geog]
-    return self.data[variant_name][(self.data[variant_name].GEOGRAPHY_CODE.isin(geog_codes)) & 
-                                   (self.data[variant_name].PROJECTED_YEAR_NAME.isin(years)) &
-                                   (self.data[variant_name].C_AGE.isin(ages)) &
-                                   (self.data[variant_name].GENDER.isin(genders))].reset_index(drop=True)
-
+    if isinstance(ages, int):
+      ages = [ages]
+    if isinstance(genders, int):
+      genders = [genders]
+    # (copy so that callers can modify the result without affecting the memo)
+    return self.__detail(variant_name, tuple(geog), tuple(years), tuple(ages), tuple(genders)).copy()
+
+  def __getstate__(self):
+    """
+    Pickles the loaded data but not the memo of detail queries (or the lock). Shared cubes and ratios are not copied, they are
+    re-attached to the published data when unpickled
+    """
+    state = dict(self.__dict__)
+    state["details"] = collections.OrderedDict()
+    del state["lock"]
+    if self.shared:
+      state["cubes"] = {}
+      state["ratios"] = {}
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.lock = threading.RLock()
+
+  def cube(self, variant_name):
+    """
+    Returns the dense (Cube) representation of a variant, loading the variant if necessary
+    """
+    # (loads are serialised, the data may be used by several threads)
+    with self.lock:
+      if not variant_name in self.cubes:
+        # is it a standard variant
+        if not variant_name in NPPData.VARIANTS:
+          raise RuntimeError("Invalid variant name / custom variants are not yet implemented")
+        if self.shared:
+          self.cubes[variant_name] = Cube.shared(self.__location(variant_name + "_cube"), lambda: self.__build_cube(variant_name))
+          # the dataframe (if it was loaded to build the cube) is no longer needed
+          if variant_name != "ppp":
+            self.data.pop(variant_name, None)
+        else:
+          self.cubes[variant_name] = self.__build_cube(variant_name)
+      return self.cubes[variant_name]
 
-  def aggregate(self, categories, variant_name, geog, years=None, ages=range(0,91), genders=[1,2]):
+  def aggregate(self, categories, variant_name, geog, years=None, ages=range(0,91), genders=[1,2], bands=None):
     """
-    Subset and aggregate the raw data
+    Subset and aggregate the raw data. If bands (see agebands.AgeBands) is given, ages are summed into the bands,
+    which are preserved (as AGE_BAND)
     """
 
-    data = self.detail(variant_name, geog, years, ages, genders)
+    if not variant_name in NPPData.VARIANTS:
+      raise RuntimeError("invalid variant name: " + variant_name)
+    years = utils.trim_range(years, self.min_year(), self.max_year())
+    if isinstance(geog, str):
+      geog = [geog]
+    geog_codes = [utils.CODES[g] for g in geog]
 
-    return data.groupby(utils.check_and_invert(categories))["OBS_VALUE"].sum().reset_index()
+    # aggregated directly from the cube, without copying the subset
+    return self.cube(variant_name).aggregate(categories, geog_codes, years, ages, genders, bands)
 
   def year_ratio(self, variant_name, geog, ref_year, year, ages=range(0,91), genders=[1,2]):
     """
     Ratio to ref_year projection for selected geog/years/ages/genders 
     """
-    # TODO do we need to (re)index these to ensure the piecewise mult is correct?
-    ref = self.detail(variant_name, geog, [ref_year], ages, genders)
-    num = self.detail(variant_name, geog, [year], ages, genders)
-
-    assert(len(ref) == len(num))
-    num.OBS_VALUE = num.OBS_VALUE / ref.OBS_VALUE
-    return num
+    if isinstance(geog, str):
+      geog = [geog]
+    geog_codes = [utils.CODES[g] for g in geog]
+    return self.year_ratios(variant_name, ref_year).filter(geog_codes, [year], ages, genders)
 
   def variant_ratio(self, variant_numerator, geog, years, ages=range(0,91), genders=[1,2]): 
     """
     Ratio to principal projection for selected geog/years/ages/genders 
     """
-    # this function only works for a single country (which is ok)
-    ref = self.detail("ppp", geog, years, ages, genders).set_index(["C_AGE", "GENDER", "PROJECTED_YEAR_NAME"])
-
-    num = self.detail(variant_numerator, geog, years, ages, genders).set_index(["C_AGE", "GENDER", "PROJECTED_YEAR_NAME"])
-
-    assert(len(ref) == len(num))
-    num.OBS_VALUE = num.OBS_VALUE / ref.OBS_VALUE
-    #print(num.query("GENDER==2 and C_AGE==6 and PROJECTED_YEAR_NAME==2018"))
+    if isinstance(geog, str):
+      geog = [geog]
+    geog_codes = [utils.CODES[g] for g in geog]
+    num = self.variant_ratios(variant_numerator).filter(geog_codes, years, ages, genders)
 
     # return multiindexed df
-    return num
+    return num.set_index(["C_AGE", "GENDER", "PROJECTED_YEAR_NAME"])
+
+  def year_ratios(self, variant_name, ref_year):
+    """
+    Returns the ratio of the projection to the ref_year projection for every country, year, gender and age,
+    as a Cube. The table is computed once (per variant and reference year)
+    """
+    return self.__ratios(variant_name, ref_year)
 
-  def force_load_variants(self, variants):
+  def variant_ratios(self, variant_name):
+    """
+    Returns the ratio of the variant to the principal projection for every country, year, gender and age,
+    as a Cube. The table is computed once (per variant)
+    """
+    return self.__ratios(variant_name, "ppp")
 
-    for variant in variants:
-      if not variant in self.data:
-        self.__load_variant(variant)
-    return 
+  def force_load_variants(self, variants=None, workers=1):
+    """
+    Loads the specified variants (default all of them). Any that are not already cached are preprocessed together,
+    in a single pass over each country's raw data. If workers > 1 the (independent) country/variant files are
+    converted in parallel by a pool of that many processes
+    """
+    if variants is None:
+      variants = NPPData.VARIANTS
+
+    with self.lock:
+      missing = []
+      for variant in variants:
+        if not variant in NPPData.VARIANTS:
+          raise RuntimeError("invalid variant name: " + variant)
+        if not variant in self.data:
+          data = cache.read(self.__variant_cache(variant))
+          if data is None:
+            missing.append(variant)
+          else:
+            self.data[variant] = cache.normalise(data, self.float32)
+
+      if missing:
+        self.__build_variants(missing, workers)
 
   def __download_ppp(self):
 
@@ -177,13 +327,80 @@ class NPPData:
     pop90plus["C_AGE"] = 90
 
     # remove the aggregated categories from the original and append the aggregate
-    ppp = ppp[ppp.C_AGE < 90].append(pop90plus, ignore_index=True)
+    ppp = pd.concat([ppp[ppp.C_AGE < 90], pop90plus], ignore_index=True)
 
     return ppp
   
+  def __ratios(self, variant_name, reference):
+    """
+    Computes (or loads) the ratio of the variant to reference, which is either a year or the principal variant "ppp"
+    """
+    with self.lock:
+      key = (variant_name, reference)
+      if key in self.ratios:
+        return self.ratios[key]
+
+      location = self.__location(variant_name + "_ratio_" + str(reference))
+      if self.shared:
+        ratios = Cube.shared(location, lambda: self.__build_ratios(variant_name, reference))
+      else:
+        ratios = Cube.load(location) if self.persist_ratios else None
+        if ratios is None:
+          ratios = self.__build_ratios(variant_name, reference)
+          if self.persist_ratios:
+            ratios.save(location)
+      self.ratios[key] = ratios
+      return ratios
+
+  def __build_ratios(self, variant_name, reference):
+    num = self.cube(variant_name)
+    if reference == "ppp":
+      den = self.cube("ppp")
+      # use the categories common to both
+      labels = [np.intersect1d(n, d) for n, d in zip(num.labels, den.labels)]
+      values = num.slice(labels[0], labels[1], labels[3], labels[2])[0] / den.slice(labels[0], labels[1], labels[3], labels[2])[0]
+    else:
+      if not reference in num.index[1]:
+        raise ValueError("reference year {} is not in the {} data".format(reference, variant_name))
+      labels = num.labels
+      values = num.values / num.values[:, [num.index[1][reference]]]
+    return Cube(values, *labels)
+
+  def __build_cube(self, variant_name):
+    if not variant_name in self.data:
+      self.__load_variant(variant_name)
+    return Cube.from_frame(self.data[variant_name])
+
+  def __location(self, name):
+    """
+    Returns the binary cache location for a derived dataset (distinguishing single precision data)
+    """
+    return cache.path(self.cache_dir + "/npp_" + name + ("32" if self.float32 else "") + ".csv")
+
+  def __detail(self, *key):
+    """
+    Slices the variant's cube, remembering the DETAIL_CACHE_SIZE most recent queries (key must be hashable)
+    """
+    with self.lock:
+      if key in self.details:
+        self.details.move_to_end(key)
+        return self.details[key]
+      (variant_name, geog, years, ages, genders) = key
+      geog_codes = [utils.CODES[g] for g in geog]
+      self.details[key] = self.cube(variant_name).filter(geog_codes, years, ages, genders)
+      if len(self.details) > NPPData.DETAIL_CACHE_SIZE:
+        self.details.popitem(last=False)
+      return self.details[key]
+
   def __load_variant(self, variant_name):
+    self.force_load_variants([variant_name])
 
-    # [4 country zips] -> [60 xml] -> [60 raw csv] -> [15 variant csv]
+  def __variant_cache(self, variant_name):
+    return self.cache_dir + "/npp_" + variant_name + ".csv"
+
+  def __build_variants(self, variant_names, workers):
+
+    # [4 country zips] -> [60 xml] -> [15 variant caches]
 
     datasets = {
       utils.EN: "https://www.ons.gov.uk/file?uri=/peoplepopulationandcommunity/populationandmigration/populationprojections/datasets/z3zippedpopulationprojectionsdatafilesengland/2016based/tablez3opendata16england.zip",
@@ -192,73 +409,27 @@ class NPPData:
       utils.NI: "https://www.ons.gov.uk/file?uri=/peoplepopulationandcommunity/populationandmigration/populationprojections/datasets/z6zippedpopulationprojectionsdatafilesnorthernireland/2016based/tablez6opendata16northernireland.zip",
     }
 
-    # check for cached data
-    dataset = self.cache_dir + "/npp_" + variant_name + ".csv"
-    if not os.path.isfile(dataset):
-      # assemble data if not already cached
-      self.data[variant_name] = pd.DataFrame()
-
-      # step 1: download, country-level zip file containing all variants (if not already there)
-      for country in datasets:
-        raw_zip = self.cache_dir + "/npp_" + country + ".zip"
-        if not os.path.isfile(raw_zip): 
-          print("downloading " + raw_zip)
-          response = requests.get(datasets[country])
-          with open(raw_zip, 'wb') as fd:
-            for chunk in response.iter_content(chunk_size=1024):
-              fd.write(chunk)   
-        else:
-          print("using " + raw_zip)
-
+    # step 1: download, country-level zip file containing all variants (if not already there), concurrently
+    download.fetch_all({self.cache_dir + "/npp_" + country + ".zip": datasets[country] for country in datasets})
+
+    # step 2: collate and reformat every required variant
+    parts = {variant_name: utils.Collector() for variant_name in variant_names}
+    if workers > 1:
+      # results are collected in submission (country, variant) order so the output doesn't depend on scheduling
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [(variant_name, executor.submit(_load_variant_zip, self.cache_dir + "/npp_" + country + ".zip", self.cache_dir, country, variant_name))
+                   for country in datasets for variant_name in variant_names]
+        for (variant_name, future) in futures:
+          parts[variant_name].add(future.result())
+    else:
+      # opening each country zip once
       for country in datasets:
         raw_zip = self.cache_dir + "/npp_" + country + ".zip"
-        z = zipfile.ZipFile(raw_zip)
-        # step 2: unzip, collate and reformat data if not presentcd
-        print("Extracting " + country + "_" + variant_name)
-        vxml = country + "_" + variant_name + "_opendata2016.xml"
-        if not os.path.isfile(self.cache_dir + "/" + vxml):
-          z.extract(vxml, path=self.cache_dir)
-        start = time.time()
-        vdata = np.array(_read_excel_xml(self.cache_dir + "/" + vxml, "Population"))
-        print("read xml in " + str(time.time() - start))
-        df = pd.DataFrame(data=vdata[1:,0:], columns=vdata[0,0:])
-        df = df.set_index(["Sex", "Age"]).stack().reset_index()
-        # remove padding
-        df.Age = df.Age.str.strip()
-        df.columns = ["GENDER", "C_AGE", "PROJECTED_YEAR_NAME", "OBS_VALUE"]
-        #print(df.head())
-
-        # list age categories we are aggregating
-        a = ["90", "91", "92", "93", "94", "95", "96", "97", "98", "99", "100", "101", "102", "103", "104", "105 - 109", "110 and over"]
-
-        # copy the data in these categories
-        dfagg = df[df.C_AGE.isin(a)]
-        #print(dfagg.head())
-
-        # The aggregration goes haywire unless the data is saved and reloaded - comment out lines below to see
-        # TODO this needs to be fixed and/or reported as a (reproducible) bug
-        tmpfile = self.cache_dir + "/tmp.csv"
-        dfagg.to_csv(tmpfile, index=False)
-        dfagg = pd.read_csv(tmpfile)
-
-        dfagg = dfagg.groupby(["GENDER", "PROJECTED_YEAR_NAME"])["OBS_VALUE"].sum().reset_index()
-        dfagg["C_AGE"] = "90"
-        #print(dfagg.head())
-
-        # print(df.head())
-        # print(dfagg.head())
-        # print(df.columns)
-        # print(dfagg.columns)
-        # remove the aggregated categories from the original and append the aggregate
-        df = df[~df.C_AGE.isin(a)].append(dfagg, ignore_index=True)
-
-        # add the country code
-        df["GEOGRAPHY_CODE"] = NPPData.CODES[country]
-
-        #df.to_csv(vcsv, index=None)
-        self.data[variant_name] = self.data[variant_name].append(df, ignore_index=True)
-      
-      # step 3: save preprocessed data
-      self.data[variant_name].to_csv(dataset, index=None)
-
-    self.data[variant_name] = pd.read_csv(dataset)
+        with zipfile.ZipFile(raw_zip) as z:
+          for variant_name in variant_names:
+            parts[variant_name].add(_load_variant_xml(z, self.cache_dir, country, variant_name))
+
+    # step 3: save preprocessed data
+    for variant_name in variant_names:
+      data = cache.write(parts[variant_name].result(), self.__variant_cache(variant_name))
+      self.data[variant_name] = cache.normalise(data, self.float32)
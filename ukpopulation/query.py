@@ -0,0 +1,98 @@
+"""
+Query - lazy query plans over SNPP data, extended with NPP data
+"""
+
+import copy
+import ukpopulation.utils as utils
+
+class Query:
+  """
+  Builds a query step by step, e.g.
+    Query(snpp, npp).geographies(["E08000021", utils.WA]).years(range(2016, 2051)).variant("hhh").aggregate(["GENDER"], agebands.BROAD)
+  Each step returns a new query (so a partial query can be reused as the basis of others) and only records the plan.
+  Nothing is computed until run(), which executes the whole plan in a single fused pass per country (see SNPPData.project):
+  filters are applied to the stored data, extrapolation and variants are applied to the selected array, the NPP ratios are
+  shared by every LAD, and aggregation is a reduction of the array, so no intermediate dataframes are materialised
+  """
+
+  def __init__(self, snpp, npp=None):
+    """
+    npp is only required to extrapolate beyond the SNPP years, or to apply variants
+    """
+    self.snpp = snpp
+    self.npp = npp
+    self.plan = {
+      "geog_codes": None,
+      "year_range": None,
+      "ages": range(0,91),
+      "genders": [1,2],
+      "variant_names": None,
+      "categories": None,
+      "bands": None
+    }
+
+  def geographies(self, geog_codes):
+    """
+    Selects LAD codes (from any countries) and/or country codes (e.g. utils.EN) meaning all of the country's LADs
+    """
+    return self.__step(geog_codes=geog_codes)
+
+  def years(self, year_range):
+    """
+    Selects years, which may extend beyond the final SNPP year (which are then extrapolated, see SNPPData.extrapolate).
+    By default all the SNPP years
+    """
+    return self.__step(year_range=year_range)
+
+  def ages(self, ages):
+    """
+    Selects ages (by default 0-90)
+    """
+    return self.__step(ages=ages)
+
+  def genders(self, genders):
+    """
+    Selects genders (by default both)
+    """
+    return self.__step(genders=genders)
+
+  def variant(self, variant_names):
+    """
+    Applies an NPP variant (see SNPPData.create_variant), or a list of variants, in which case run() returns a dict of
+    results keyed by variant name. The principal projection ("ppp") is computed once and shared by all the variants
+    """
+    if self.npp is None:
+      raise ValueError("NPP data is required to apply variants")
+    return self.__step(variant_names=variant_names)
+
+  def aggregate(self, categories, bands=None):
+    """
+    Sums over categories, optionally summing ages into bands (see agebands.AgeBands) which are preserved (as AGE_BAND)
+    """
+    # validate now rather than when run
+    if bands is None:
+      utils.check_and_invert(categories)
+    else:
+      bands.preserved(categories)
+    return self.__step(categories=categories, bands=bands)
+
+  def run(self):
+    """
+    Executes the plan, returning a dataframe (or a dict of dataframes keyed by variant name, see variant)
+    """
+    if self.plan["geog_codes"] is None:
+      raise ValueError("no geography codes specified")
+    variant_names = self.plan["variant_names"]
+    if variant_names is None:
+      variant_names = "ppp"
+    plan = dict(self.plan, variant_names=[variant_names] if isinstance(variant_names, str) else variant_names)
+    results = self.snpp.project(self.npp, **plan)
+    return results[variant_names] if isinstance(variant_names, str) else results
+
+  def __step(self, **changes):
+    """
+    Returns a copy of the query with the plan updated
+    """
+    query = copy.copy(self)
+    query.plan = dict(self.plan, **changes)
+    return query
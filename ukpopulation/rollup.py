@@ -0,0 +1,35 @@
+"""
+Rollups - population totals for groups of LADs: countries, EW, GB and UK, or user-defined groupings such as regions,
+combined authorities or LEPs
+"""
+
+import ukpopulation.utils as utils
+from ukpopulation.cube import Cube
+
+# ONS codes for the standard groupings, and their constituent countries
+GROUPINGS = {
+  utils.CODES[utils.EN]: [utils.EN],
+  utils.CODES[utils.WA]: [utils.WA],
+  utils.CODES[utils.SC]: [utils.SC],
+  utils.CODES[utils.NI]: [utils.NI],
+  "K04000001": utils.EW,
+  "K03000001": utils.GB,
+  "K02000001": utils.UK
+}
+
+def national_groups(geog_codes):
+  """
+  Returns the standard groupings (see GROUPINGS) of the given LAD codes, as a dict of group code: list of LAD codes
+  """
+  return {group: [code for code in geog_codes if utils.country(code) in countries] for group, countries in GROUPINGS.items()}
+
+def rollup(data, groups=None):
+  """
+  Returns the totals for groups (default the standard groupings) of the LADs in data, which must be in long format with
+  GEOGRAPHY_CODE, PROJECTED_YEAR_NAME, GENDER, C_AGE and OBS_VALUE columns (e.g. MYE, SNPP, extrapolated or variant data).
+  The result has the same format, with the group codes in place of the LAD codes
+  """
+  cube = Cube.from_frame(data)
+  if groups is None:
+    groups = national_groups(cube.labels[0])
+  return cube.rollup(groups).filter(None, None, None, None)
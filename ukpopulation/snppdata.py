@@ -1,21 +1,142 @@
 import os.path
 import json
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
-import requests
 from openpyxl import load_workbook
 import ukcensusapi.Nomisweb as Api
 import ukpopulation.utils as utils
+import ukpopulation.cache as cache
+import ukpopulation.download as download
+import ukpopulation.rollup as rollup
+from ukpopulation.cube import Cube
+from ukpopulation.query import Query
 
-def _read_cell_range(worksheet, topleft, bottomright):
-  data_rows = []
-  for row in worksheet[topleft:bottomright]:
-    data_cols = []
-    for cell in row:
-      data_cols.append(cell.value)
-    data_rows.append(data_cols)
-  return np.array(data_rows)
+def _read_sheet(worksheet, max_row, max_col):
+  """
+  Reads the cell values in the top-left max_row x max_col region of a worksheet, in a single pass, into an array
+  """
+  block = np.full((max_row, max_col), None, dtype=object)
+  for i, row in enumerate(worksheet.iter_rows(max_row=max_row, max_col=max_col, values_only=True)):
+    block[i, :len(row)] = row
+  return block
+
+def _ni_block(block):
+  """
+  Splits a block of NI data with years in the first row and ages in the first column into (ages, years, values [age, year])
+  """
+  years = block[0, 1:].astype(int)
+  # "90+" is 90, and any (sub)heading rows are skipped
+  ages = pd.to_numeric(pd.Series(block[1:, 0]).astype(str).str.rstrip("+"), errors="coerce").values
+  rows = ~np.isnan(ages)
+  return (ages[rows].astype(int), years, block[1:][rows, 1:].astype(float))
+
+def _read_odata(url, convert, workers=download.MAX_WORKERS, page_size=1000):
+  """
+  Returns the result of an OData query (url must already contain query options) as a list of chunks, one per page,
+  each the page's records converted by convert. The first page gives the total count and the server's page size, so
+  the offsets of the remaining pages are known and they are requested concurrently by (at most) workers threads
+  """
+  def get(url):
+    response = download.session().get(url, timeout=download.TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+  def page(skip, top):
+    records = get(url + "&$skip={}&$top={}".format(skip, top))["value"]
+    return (len(records), convert(records))
+
+  first = get(url + "&$inlinecount=allpages&$skip=0&$top={}".format(page_size))
+  chunks = [convert(first["value"])]
+
+  # if the server doesn't report the count, follow the links from page to page
+  if not "odata.count" in first:
+    while "odata.nextLink" in first:
+      first = get(first["odata.nextLink"])
+      chunks.append(convert(first["value"]))
+    return chunks
+
+  count = int(first["odata.count"])
+  # (the server may return fewer rows per page than requested)
+  top = len(first["value"])
+  received = top
+  if top and top < count:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      for (n, chunk) in executor.map(lambda skip: page(skip, top), range(top, count, top)):
+        received += n
+        chunks.append(chunk)
+  if received != count:
+    raise IOError("OData query {} returned {} rows, expected {}".format(url, received, count))
+  return chunks
+
+def _wales_chunk(records):
+  """
+  Converts StatsWales records to SNPP format (single years of age only)
+  """
+  fields = ["Area_AltCode1", "Year_Code", "Data", "Gender_Code", "Age_Code"]
+  chunk = pd.DataFrame.from_records(records, columns=fields)
+  chunk = chunk.rename(columns={"Age_Code": "C_AGE", 
+                                "Area_AltCode1": "GEOGRAPHY_CODE",
+                                "Data": "OBS_VALUE", 
+                                "Gender_Code": "GENDER", 
+                                "Year_Code": "PROJECTED_YEAR_NAME"})
+  # Remove all but SYOA and make numeric 
+  chunk = chunk[~chunk.C_AGE.isin(["AllAges", "00To15", "16To64", "65Plus"])]
+  chunk = chunk.assign(C_AGE=chunk.C_AGE.replace({"90Plus": "90"}),
+                       # convert gender to census convention 1=M, 2=F
+                       GENDER=chunk.GENDER.map({"M": 1, "F": 2}))
+  return cache.normalise(chunk)
+
+def _read_zip_members(zip_file, members, read, workers=download.MAX_WORKERS):
+  """
+  Returns read(file) for each of the members of a zip file (in order), reading them concurrently with (at most) workers
+  threads, each of which opens its own handle to the zip file
+  """
+  def read_member(member):
+    with zipfile.ZipFile(zip_file) as z:
+      with z.open(member) as file:
+        return read(file)
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    return list(executor.map(read_member, members))
+
+def _scotland_table(file):
+  """
+  Reads a Scotland population CSV into a council area x age table
+  """
+  return pd.read_csv(file
+  ).drop(["Area", "All Ages"], axis=1
+  ).drop(0 
+  ).rename(columns={"90 and over": "90"}
+  ).set_index("Code")
+
+class _CountryData(dict):
+  """
+  Dictionary of per-country data in which each country is loaded (by calling load(country)) on first access
+  """
+  def __init__(self, load, loaded={}):
+    super().__init__(loaded)
+    self.load = load
+
+  def __missing__(self, country):
+    if not country in utils.UK:
+      raise KeyError(country)
+    self[country] = self.load(country)
+    return self[country]
+
+class _CubeFrames(dict):
+  """
+  Dictionary of per-country dataframes constructed from the dense data (Cubes) on each access, and not retained
+  """
+  def __init__(self, cubes):
+    super().__init__()
+    self.cubes = cubes
+
+  def __missing__(self, country):
+    if not country in utils.UK:
+      raise KeyError(country)
+    return self.cubes[country].filter(None, None, None, None)
 
 class SNPPData:
   """
@@ -24,122 +145,432 @@ class SNPPData:
   Wales/Scotland/NI are not the responsiblity of ONS and are made avilable online by the relevant statistical agency
   """  
 
-  def __init__(self, cache_dir=None):
+  # downloaded source files: country -> (preprocessed cache file, raw file, url)
+  SOURCES = {
+    utils.WA: ("snpp_w.csv", None, "http://open.statswales.gov.wales/dataset/popu5099"),
+    utils.SC: ("snpp_s.csv", "snpp_s.zip", "https://www.nrscotland.gov.uk/files//statistics/population-projections/sub-national-pp-16/detailed/CA%201.zip"),
+    utils.NI: ("snpp_ni.csv", "ni_raw.xlsx", "https://www.nisra.gov.uk/sites/nisra.gov.uk/files/publications/SNPP16_LGD14_SYA_1641.xlsx")
+  }
+
+  # NI worksheet names (1 per LAD equivalent). Easier to hard-code the worksheet names we need (since unlikely to change frequently)
+  NI_DISTRICTS = ["Antrim & Newtownabbey",
+                  "Ards & North Down",
+                  "Armagh Banbridge & Craigavon",
+                  "Belfast",
+                  "Causeway Coast & Glens",
+                  "Derry & Strabane",
+                  "Fermanagh & Omagh",
+                  "Lisburn & Castlereagh",
+                  "Mid & East Antrim",
+                  "Mid Ulster",
+                  "Newry Mourne & Down"]
+
+  def __init__(self, cache_dir=None, dense=False, float32=False, shared=False):
+    """
+    Each country's data is loaded when first referenced (call preload() to load everything up front).
+    If dense is True, each country's data is additionally held as a Cube (a dense array indexed by geography, year,
+    gender and age) in place of the dataframe, and filter/aggregate queries are answered by slicing it rather than by masking
+    the dataframe. The data attribute then constructs a country's dataframe from its cube each time it is accessed (so
+    prefer the query methods).
+    If shared is True (which implies dense) the cubes are published to cache_dir by the first process to need them
+    and memory-mapped read-only by every process, so that any number of workers share a single copy of the data.
+    Loaded data has compact column types (see cache.normalise), and if float32 is True the values are held in single precision
+    """
     if cache_dir is None:
       cache_dir = utils.default_cache_dir()
     self.cache_dir = cache_dir
     self.data_api = Api.Nomisweb(self.cache_dir) 
 
-    self.data = {}
-    self.data[utils.EN] = self.__do_england()
-    self.data[utils.WA] = self.__do_wales()
-    self.data[utils.SC] = self.__do_scotland()
-    self.data[utils.NI] = self.__do_nireland()
+    self.float32 = float32
+
+    # dense array representation keyed by country (if enabled)
+    self.shared = shared
+    self.dense = dense or shared
+    self.cubes = _CountryData(self.__cube)
+
+    # dataframes keyed by country (lazy retrieval, or constructed from the cubes if dense)
+    self.data = _CubeFrames(self.cubes) if self.dense else _CountryData(self.__load)
+    # totals for groups of LADs (Cubes), keyed by grouping
+    self.rollups = {}
 
     # LADs * 26 years * 91 ages * 2 genders
     #assert len(self.data) == (326+22+32+11) * 26 * 91 * 2
 
+  def __getstate__(self):
+    """
+    Pickles the loaded data (but not the loaders, which are bound methods). Shared cubes are not copied, they are
+    re-attached to the published data when unpickled
+    """
+    state = dict(self.__dict__)
+    state["data"] = dict(self.data)
+    state["cubes"] = {} if self.shared else dict(self.cubes)
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.cubes = _CountryData(self.__cube, state["cubes"])
+    self.data = _CubeFrames(self.cubes) if self.dense else _CountryData(self.__load, state["data"])
+
+  def preload(self):
+    """
+    Loads the data for every country (rather than on first use). Any source files required are downloaded concurrently
+    """
+    sources = {}
+    for country, (cached, raw, url) in SNPPData.SOURCES.items():
+      cached = self.cache_dir + "/" + cached
+      # (a legacy CSV cache is migrated rather than rebuilt, see cache.read)
+      if raw is not None and not country in (self.cubes if self.dense else self.data) and not os.path.isdir(cache.path(cached)) and not os.path.isfile(cached):
+        sources[self.cache_dir + "/" + raw] = url
+    download.fetch_all(sources)
+
+    for country in utils.UK:
+      if self.dense:
+        self.cubes[country]
+      else:
+        self.data[country]
+
   def min_year(self, code):
     """
     Returns the first year in the projection
     """
-    return min(self.data[utils.country(code)].PROJECTED_YEAR_NAME.unique())
+    if self.dense:
+      return int(self.cubes[utils.country(code)].labels[1][0])
+    return int(self.data[utils.country(code)].PROJECTED_YEAR_NAME.min())
 
   def max_year(self, code):
     """
     Returns the final year in the projection
     """
-    return max(self.data[utils.country(code)].PROJECTED_YEAR_NAME.unique())
+    if self.dense:
+      return int(self.cubes[utils.country(code)].labels[1][-1])
+    return int(self.data[utils.country(code)].PROJECTED_YEAR_NAME.max())
 
   def filter(self, geog_codes, years=None, ages=range(0,91), genders=[1,2]):
+    """
+    Returns the data for the given geographies, which can be LAD codes from any countries and/or country codes (meaning
+    all of the country's LADs). Each country is filtered in a single operation and the results combined
+    """
+    return self.__combine(self.__per_country(lambda country, codes: self.__filter(country, codes, years, ages, genders), geog_codes))
 
-    # convert geog_codes and years to arrays if single values supplied (for isin)
-    if isinstance(geog_codes, str):
-      geog_codes = [geog_codes]
-
-    # the assumption is that all geog_codes are in same country
-    country = utils.country(geog_codes[0])
-
-    years = utils.trim_range(years, self.min_year(geog_codes[0]), self.max_year(geog_codes[0]))
-
-    # apply filters
-    return self.data[country][(self.data[country].GEOGRAPHY_CODE.isin(geog_codes)) & 
-                              (self.data[country].PROJECTED_YEAR_NAME.isin(years)) &
-                              (self.data[country].C_AGE.isin(ages)) &
-                              (self.data[country].GENDER.isin(genders))].reset_index(drop=True)
-
-  def aggregate(self, categories, geog_codes, years=None, ages=range(0,91), genders=[1,2]):
-
-    data = self.filter(geog_codes, years, ages, genders)
-
+  def aggregate(self, categories, geog_codes, years=None, ages=range(0,91), genders=[1,2], bands=None):
+    """
+    Filters (see filter) then sums over categories. If bands (see agebands.AgeBands) is given, ages are summed into
+    the bands, which are preserved (as AGE_BAND)
+    """
     # invert categories (they're the ones to aggregate, not preserve)
-    return data.groupby(utils.check_and_invert(categories))["OBS_VALUE"].sum().reset_index()
+    preserved = utils.check_and_invert(categories) if bands is None else bands.preserved(categories)
+    results = self.__per_country(lambda country, codes: self.__aggregate(categories, country, codes, years, ages, genders, bands), geog_codes)
+    if len(results) == 1:
+      return results[0]
+    # combine the per-country sums
+    return self.__combine(results).groupby(preserved, observed=True)["OBS_VALUE"].sum().reset_index()
+
+  def rollup(self, groups=None, years=None, ages=range(0,91), genders=[1,2]):
+    """
+    Returns the totals for groups of LADs, by default the countries, EW, GB and UK (see rollup.GROUPINGS), otherwise
+    groups is a dict of group code: list of LAD codes (e.g. regions). The totals for all years, genders and ages are
+    computed once per grouping, then filtered. A total is missing for any year in which not all its LADs have data
+    """
+    key = None if groups is None else tuple(sorted((code, tuple(groups[code])) for code in groups))
+    if not key in self.rollups:
+      countries = utils.UK if groups is None else sorted({utils.country(code) for members in groups.values() for code in members})
+      cube = Cube.stack([self.cubes[country] if self.dense else Cube.from_frame(self.data[country]) for country in countries])
+      if groups is None:
+        groups = rollup.national_groups(cube.labels[0])
+      self.rollups[key] = cube.rollup(groups)
+    return self.rollups[key].filter(None, years, ages, genders)
 
-  # For now one LAD at a time (due to multiple countries)
   # For now allow extrapolation of years already in data
   # Filtering age and gender is not (currently) supported
-  def extrapolate(self, npp, geog_code, year_range):
+  def extrapolate(self, npp, geog_codes, year_range):
+    """
+    Extrapolate beyond the final SNPP year using the NPP (principal) ratio of each year to the final year, by age and gender.
+    geog_codes can be a LAD code, a list of LADs (from any countries), or country codes (e.g. utils.EN) for all their LADs.
+    For each country the NPP ratios are computed once and applied to every LAD's final-year population in a single array operation.
+    Rows are ordered by geography, year, gender and age (see project)
+    """
+    return self.project(npp, geog_codes, year_range)["ppp"]
+
+  def extrapolagg(self, categories, npp, geog_codes, year_range, bands=None):
+    """
+    Extrapolate and then aggregate (optionally into age bands, see aggregate)
+    """
+    return self.project(npp, geog_codes, year_range, categories=categories, bands=bands)["ppp"]
+
+  def create_variant(self, variant_name, npp, geog_codes, year_range):
+    """
+    Apply NPP variant to SNPP: SNPP(v) = SNPP(0) * sum(a,g) [ NPP(v) / NPP(0) ]
+    Preserves age-gender structure of SNPP data
+    """  
+    return self.create_variants([variant_name], npp, geog_codes, year_range)[variant_name]
 
-    (in_range, ex_range) = utils.split_range(year_range, self.max_year(geog_code))
+  def create_variants(self, variant_names, npp, geog_codes, year_range):
+    """
+    Apply each NPP variant to every LAD (see create_variant), returning a dict of dataframes keyed by variant name.
+    geog_codes are as per extrapolate. For each country the principal projection (extrapolated as necessary) is computed
+    once and shared by all the variants (see project). Variants are not applied to any years that predate the NPP data
+    """
+    return self.project(npp, geog_codes, year_range, variant_names=variant_names)
 
-    all_years = self.filter(geog_code, in_range)
+  def query(self, npp=None):
+    """
+    Returns a lazy query over this data (see query.Query). npp is only required for extrapolation and variants
+    """
+    return Query(self, npp)
 
-    for year in ex_range:
-      data = self.filter([geog_code], [self.max_year(geog_code)])
-      scaling = npp.year_ratio("ppp", utils.country(geog_code), self.max_year(geog_code), year)
-      assert(len(data == len(scaling)))
-      data.OBS_VALUE = data.OBS_VALUE * scaling.OBS_VALUE
-      data.PROJECTED_YEAR_NAME = year
-      all_years = all_years.append(data, ignore_index=True)
+  def project(self, npp, geog_codes, year_range=None, ages=range(0,91), genders=[1,2], variant_names=["ppp"], categories=None, bands=None):
+    """
+    Fused filter, extrapolate, create_variants and aggregate (see query.Query, which builds the arguments lazily).
+    For each country the selected ages and genders of the principal projection (extrapolated beyond the final SNPP year as
+    necessary) are computed once as an array, each variant is applied to it, and the result is aggregated over categories
+    (or, if categories is None, returned in full) directly from the array, so no intermediate dataframes are constructed.
+    Returns a dict of dataframes keyed by variant name ("ppp" being the principal projection)
+    """
+    if isinstance(variant_names, str):
+      variant_names = [variant_names]
+    if isinstance(ages, int):
+      ages = [ages]
+    if isinstance(genders, int):
+      genders = [genders]
+    # fail before doing any work
+    if categories is not None:
+      preserved = utils.check_and_invert(categories) if bands is None else bands.preserved(categories)
+    elif bands is not None:
+      raise ValueError("bands require categories to aggregate over")
+
+    results = self.__per_country(lambda country, codes: self.__project(npp, country, codes, year_range, ages, genders, variant_names, categories, bands), geog_codes)
+    projected = {}
+    for variant_name in variant_names:
+      data = [result[variant_name] for result in results]
+      if categories is not None and len(data) > 1:
+        # combine the per-country sums
+        projected[variant_name] = self.__combine(data).groupby(preserved, observed=True)["OBS_VALUE"].sum().reset_index()
+      else:
+        projected[variant_name] = self.__combine(data)
+    return projected
+
+  def iter_extrapolate(self, npp, geog_codes, year_range, chunk_size=32):
+    """
+    Generator version of extrapolate, yielding (geog_code, data) for each LAD in turn. LADs are processed chunk_size at a time,
+    so that only that many LADs' results are held in memory at once
+    """
+    return self.__iterate(lambda codes: self.extrapolate(npp, codes, year_range), geog_codes, chunk_size)
 
-    return all_years
+  def iter_extrapolagg(self, categories, npp, geog_codes, year_range, chunk_size=32, bands=None):
+    """
+    Generator version of extrapolagg, yielding (geog_code, data) for each LAD in turn (see iter_extrapolate).
+    Each LAD is aggregated separately, so categories cannot include GEOGRAPHY_CODE
+    """
+    if "GEOGRAPHY_CODE" in categories:
+      raise ValueError("GEOGRAPHY_CODE cannot be aggregated when iterating over LADs")
+    return self.__iterate(lambda codes: self.extrapolagg(categories, npp, codes, year_range, bands), geog_codes, chunk_size)
 
-  def extrapolagg(self, categories, npp, geog_code, year_range):
+  def iter_variant(self, variant_name, npp, geog_codes, year_range, chunk_size=32):
     """
-    Extrapolate and then aggregate
+    Generator version of create_variant, yielding (geog_code, data) for each LAD in turn (see iter_extrapolate)
     """
-    data = self.extrapolate(npp, geog_code, year_range)
+    for (geog_code, variants) in self.iter_variants([variant_name], npp, geog_codes, year_range, chunk_size):
+      yield (geog_code, variants[variant_name])
 
-    # invert categories (they're the ones to aggregate, not preserve)
-    return data.groupby(utils.check_and_invert(categories))["OBS_VALUE"].sum().reset_index()
+  def iter_variants(self, variant_names, npp, geog_codes, year_range, chunk_size=32):
+    """
+    Generator version of create_variants, yielding (geog_code, dict of data keyed by variant name) for each LAD in turn
+    (see iter_extrapolate)
+    """
+    if isinstance(variant_names, str):
+      variant_names = [variant_names]
+    geog_codes = self.__geog_codes(geog_codes)
+    for i in range(0, len(geog_codes), chunk_size):
+      chunk = geog_codes[i:i + chunk_size]
+      variants = {variant_name: SNPPData.__split(data) for (variant_name, data) in self.create_variants(variant_names, npp, chunk, year_range).items()}
+      for geog_code in chunk:
+        if geog_code in variants[variant_names[0]]:
+          yield (geog_code, {variant_name: variants[variant_name][geog_code] for variant_name in variant_names})
+
+  def __iterate(self, compute, geog_codes, chunk_size):
+    """
+    Yields (geog_code, data) for each LAD, computing the data for chunk_size LADs at a time
+    """
+    geog_codes = self.__geog_codes(geog_codes)
+    for i in range(0, len(geog_codes), chunk_size):
+      chunk = geog_codes[i:i + chunk_size]
+      data = SNPPData.__split(compute(chunk))
+      for geog_code in chunk:
+        if geog_code in data:
+          yield (geog_code, data[geog_code])
+
+  @staticmethod
+  def __split(data):
+    """
+    Splits data into a dict of dataframes keyed by geography code
+    """
+    return {geog_code: group.reset_index(drop=True) for (geog_code, group) in data.groupby("GEOGRAPHY_CODE", observed=True, sort=False)}
 
-  def create_variant(self, variant_name, npp, geog_codes, year_range):
+  def __geog_codes(self, geog_codes):
+    """
+    Returns a list of LAD codes from a single code or a list of codes, in which country codes are expanded to all the
+    LADs in that country
     """
-    Apply NPP variant to SNPP: SNPP(v) = SNPP(0) * sum(a,g) [ NPP(v) / NPP(0) ]
-    Preserves age-gender structure of SNPP data
-    """  
-    result = pd.DataFrame()
     if isinstance(geog_codes, str):
       geog_codes = [geog_codes]
-    
-    for geog_code in geog_codes:
+    codes = []
+    for code in geog_codes:
+      if code in utils.UK:
+        if self.dense:
+          codes.extend(self.cubes[code].labels[0])
+        else:
+          codes.extend(sorted(self.data[code].GEOGRAPHY_CODE.unique()))
+      else:
+        codes.append(code)
+    return codes
 
-      # split out any years prior to the NPP data (currently SNPP is 2014 based but NPP is 2016)
-      (pre_range, in_range) = utils.split_range(year_range, npp.min_year() - 1)
-      # for any years prior to NPP we just use the SNPP data as-is (i.e. "ppp")
-      pre_data = self.filter(geog_code, pre_range)
-      if len(pre_data) > 0:
-        print("WARNING: variant {} not applied for years {} that predate the NPP data".format(variant_name, pre_range))
+  def __per_country(self, function, geog_codes):
+    """
+    Partitions geog_codes by country and returns a list of function(country, codes) for each partition.
+    Multiple partitions are processed concurrently
+    """
+    partitions = {}
+    for code in self.__geog_codes(geog_codes):
+      partitions.setdefault(utils.country(code), []).append(code)
+    if not partitions:
+      raise ValueError("no geography codes specified")
+    if len(partitions) == 1:
+      return [function(*partition) for partition in partitions.items()]
+    with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+      return list(executor.map(lambda partition: function(*partition), partitions.items()))
+
+  def __combine(self, results):
+    """
+    Combines the per-country results into a single dataframe
+    """
+    if len(results) == 1:
+      return results[0]
+    collector = utils.Collector()
+    for result in results:
+      collector.add(result)
+    # (the geography categories differ)
+    return utils.remove_unused_categories(cache.normalise(collector.result(), self.float32))
+
+  def __filter(self, country, geog_codes, years, ages, genders):
+    """
+    Filters the data for LADs in a single country
+    """
+    years = utils.trim_range(years, self.min_year(country), self.max_year(country))
+
+    if self.dense:
+      return self.cubes[country].filter(geog_codes, years, ages, genders)
 
-      # return if there's nothing in the NPP range
-      if not in_range:
-        result.append(pre_data)
-        continue
+    # apply filters (retaining only the selected geography categories, as in dense mode)
+    data = self.data[country]
+    return utils.remove_unused_categories(data[(data.GEOGRAPHY_CODE.isin(geog_codes)) &
+                                               (data.PROJECTED_YEAR_NAME.isin(years)) &
+                                               (data.C_AGE.isin(ages)) &
+                                               (data.GENDER.isin(genders))].reset_index(drop=True))
 
-      data = self.extrapolate(npp, geog_code, in_range).sort_values(["C_AGE", "GENDER", "PROJECTED_YEAR_NAME"]).reset_index(drop=True)
+  def __aggregate(self, categories, country, geog_codes, years, ages, genders, bands):
+    """
+    Filters then aggregates the data for LADs in a single country
+    """
+    if self.dense:
+      years = utils.trim_range(years, self.min_year(country), self.max_year(country))
+      return self.cubes[country].aggregate(categories, geog_codes, years, ages, genders, bands)
 
-      scaling = npp.variant_ratio(variant_name, utils.country(geog_code), year_range).reset_index().sort_values(["C_AGE", "GENDER", "PROJECTED_YEAR_NAME"])
-      #scaling.to_csv(variant_name + ".csv", index=False)
+    if bands is not None:
+      return bands.aggregate(self.__filter(country, geog_codes, years, ages, genders), categories)
 
-      #print("DF: ", len(data), ":", len(scaling))
-      assert(len(data) == len(scaling))
-      data.OBS_VALUE = data.OBS_VALUE * scaling.OBS_VALUE
-      
-      # prepend any pre-NPP data
-      result = result.append(pre_data.append(data))
+    # filter and aggregate in one pass, without copying the subset
+    years = utils.trim_range(years, self.min_year(country), self.max_year(country))
+    subset = {"GEOGRAPHY_CODE": geog_codes, "PROJECTED_YEAR_NAME": years, "C_AGE": ages, "GENDER": genders}
+    return utils.aggregate(self.data[country], categories, subset)
 
+  def __project(self, npp, country, geog_codes, year_range, ages, genders, variant_names, categories, bands):
+    """
+    Projects LADs in a single country (see project)
+    """
+    if year_range is None:
+      year_range = range(self.min_year(country), self.max_year(country) + 1)
+    principal = self.__principal(npp, country, geog_codes, year_range, ages, genders)
+
+    (geogs, years, genders, ages) = principal.labels
+    (pre_range, npp_range) = utils.split_range(years, npp.min_year() - 1) if npp is not None else (list(years), [])
+    if pre_range and any(variant_name != "ppp" for variant_name in variant_names):
+      print("WARNING: variants {} not applied for years {} that predate the NPP data".format(variant_names, pre_range))
+    result = {}
+    for variant_name in variant_names:
+      if variant_name == "ppp":
+        cube = principal
+      else:
+        # NPP ratios of variant to principal: [1, year, gender, age]
+        (scaling, labels) = npp.variant_ratios(variant_name).slice(utils.CODES[country], npp_range, ages, genders)
+        (values, _) = principal.slice(None, labels[1], ages, genders)
+        # prepend any pre-NPP years, to which the variant isn't applied
+        (pre_values, _) = principal.slice(None, pre_range, ages, genders)
+        values = np.concatenate([pre_values, (values * scaling).astype(principal.values.dtype)], axis=1)
+        cube = Cube(values, geogs, np.concatenate([pre_range, labels[1]]).astype(int), genders, ages)
+      if categories is None:
+        result[variant_name] = cube.filter(None, None, None, None)
+      else:
+        result[variant_name] = cube.aggregate(categories, None, None, None, None, bands)
     return result
 
+  def __principal(self, npp, country, geog_codes, year_range, ages, genders):
+    """
+    Returns the principal projection for the given LADs (in country), years, ages and genders as a Cube, extrapolating
+    (see extrapolate) any years beyond the final SNPP year
+    """
+    max_year = self.max_year(country)
+    (in_range, ex_range) = utils.split_range(year_range, max_year)
+
+    # [geog, year, gender, age]
+    principal = self.__subcube(country, geog_codes, in_range, ages, genders)
+    if ex_range:
+      if npp is None:
+        raise ValueError("NPP data is required to extrapolate beyond {}".format(max_year))
+      base = self.__subcube(country, geog_codes, [max_year], ages, genders)
+      (scaling, labels) = npp.year_ratios("ppp", max_year).slice(utils.CODES[country], ex_range, base.labels[3], base.labels[2])
+      extrapolated = Cube(base.values * scaling, base.labels[0], labels[1], base.labels[2], base.labels[3])
+      if principal.values.size:
+        # (the in-range years all precede the extrapolated years)
+        principal = Cube(np.concatenate([principal.values, extrapolated.values], axis=1), extrapolated.labels[0],
+                         np.concatenate([principal.labels[1], extrapolated.labels[1]]), *extrapolated.labels[2:])
+      else:
+        principal = extrapolated
+    if self.float32:
+      principal = Cube(principal.values.astype(np.float32), *principal.labels)
+    return principal
+
+  def __subcube(self, country, geog_codes, years, ages, genders):
+    """
+    Returns the data for the given LADs (in country), years, ages and genders as a Cube
+    """
+    if self.dense:
+      years = utils.trim_range(years, self.min_year(country), self.max_year(country))
+      (values, labels) = self.cubes[country].slice(geog_codes, years, ages, genders)
+      return Cube(values, *labels)
+    return Cube.from_frame(self.__filter(country, geog_codes, years, ages, genders))
+
+  def __load(self, country):
+    """
+    Loads (downloading and collating if necessary) a country's data
+    """
+    loaders = {
+      utils.EN: self.__do_england,
+      utils.WA: self.__do_wales,
+      utils.SC: self.__do_scotland,
+      utils.NI: self.__do_nireland
+    }
+    return cache.normalise(loaders[country](), self.float32)
+
+  def __cube(self, country):
+    """
+    Constructs the dense representation of a country's data, or attaches to the published copy if shared
+    """
+    if self.shared:
+      location = cache.path(self.cache_dir + "/snpp_" + country + "_cube" + ("32" if self.float32 else "") + ".csv")
+      return Cube.shared(location, lambda: Cube.from_frame(self.__load(country)))
+    # the dataframe is only needed to build the cube, all queries use the cube
+    return Cube.from_frame(self.__load(country))
+
   def __do_england(self):
     # return self.__do_england_ons() # 2014
     return self.__do_england_nomisweb() # 2016
@@ -159,10 +590,12 @@ class SNPPData:
       "select": "geography_code,projected_year_name,gender,c_age,obs_value",
       "geography": "1946157057...1946157382"
     }
-    snpp_e = self.data_api.get_data(table_internal, query_params)
+    batches = utils.Collector()
+    batches.add(self.data_api.get_data(table_internal, query_params))
 
     query_params["projected_year"] = "2030...2041"
-    snpp_e = snpp_e.append(self.data_api.get_data(table_internal, query_params))
+    batches.add(self.data_api.get_data(table_internal, query_params))
+    snpp_e = batches.result()
     # make age actual year
     snpp_e.C_AGE = snpp_e.C_AGE - 101
 
@@ -176,19 +609,14 @@ class SNPPData:
     england_raw = self.cache_dir + "/snpp_e.csv"
     england_zip = self.cache_dir + "/snpp_e.zip"
 
-    if os.path.isfile(england_raw): 
-      snpp_e = pd.read_csv(england_raw)
-    else: 
-      response = requests.get(england_src)
-      with open(england_zip, 'wb') as fd:
-        for chunk in response.iter_content(chunk_size=1024):
-          fd.write(chunk)
-        print("Downloaded", england_zip)
+    snpp_e = cache.read(england_raw)
+    if snpp_e is None:
+      download.fetch(england_src, england_zip)
 
       z = zipfile.ZipFile(england_zip)
       #print(z.namelist())  
 
-      snpp_e = pd.DataFrame()
+      chunks = utils.Collector()
       for gender in [1,2]:
         filename = "2014 SNPP Population "+("males" if gender==1 else "females")+".csv"
         chunk = pd.read_csv(z.open(filename)
@@ -202,10 +630,11 @@ class SNPPData:
         # chunk = chunk.stack().reset_index() 
         chunk.columns = ["GEOGRAPHY_CODE", "C_AGE", "PROJECTED_YEAR_NAME", "OBS_VALUE"]
         chunk["GENDER"] = gender
-        snpp_e = snpp_e.append(chunk)
+        chunks.add(chunk)
+      snpp_e = chunks.result()
 
       #assert(len(snpp_e) == 26*2*91*326) # 326 districts x 91 ages x 2 genders x 26 years
-      snpp_e.to_csv(england_raw, index=False)
+      snpp_e = cache.write(snpp_e, england_raw)
 
     #snpp_e[(snpp_e.GEOGRAPHY_CODE=="E08000021") & (snpp_e.PROJECTED_YEAR_NAME==2039)].to_csv("snpp_ncle_2014.csv")
     return snpp_e
@@ -214,144 +643,88 @@ class SNPPData:
   def __do_wales(self):
     print("Collating SNPP data for Wales...")
 
-    wales_raw = self.cache_dir + "/snpp_w.csv"
-    if os.path.isfile(wales_raw): 
-      snpp_w = pd.read_csv(wales_raw)
-    else:
-      fields = ['Area_AltCode1','Year_Code','Data','Gender_Code','Age_Code','Area_Hierarchy','Variant_Code']
+    (cached, _, wales_src) = SNPPData.SOURCES[utils.WA]
+    wales_raw = self.cache_dir + "/" + cached
+    snpp_w = cache.read(wales_raw)
+    if snpp_w is None:
+      fields = ['Area_AltCode1','Year_Code','Data','Gender_Code','Age_Code']
       # StatsWales is an OData endpoint, so select fields of interest
-      url = "http://open.statswales.gov.wales/dataset/popu5099?$select={}".format(",".join(fields))
+      url = wales_src + "?$select={}".format(",".join(fields))
       # use OData syntax to filter P (persons), AllAges (all ages), Area_Hierarchy 596 (LADs)
       url += "&$filter=Gender_Code ne 'P' and Area_Hierarchy eq 596 and Variant_Code eq 'Principal'"
-      # 
-      data = []
-      while True:
-        print(url)
-        r = requests.get(url)
-        r_data = r.json()
-        data += r_data['value']
-        if "odata.nextLink" in r_data:
-          url = r_data["odata.nextLink"]
-        else:
-          break
-      snpp_w = pd.DataFrame(data)
-
-      # Remove unwanted and rename wanted columns
-      snpp_w = snpp_w.drop(["Area_Hierarchy", "Variant_Code"], axis=1)
-      snpp_w = snpp_w.rename(columns={"Age_Code": "C_AGE", 
-                                      "Area_AltCode1": "GEOGRAPHY_CODE",
-                                      "Data": "OBS_VALUE", 
-                                      "Gender_Code": "GENDER", 
-                                      "Year_Code": "PROJECTED_YEAR_NAME"})
-      # Remove all but SYOA and make numeric 
-      snpp_w = snpp_w[(snpp_w.C_AGE!="AllAges") & (snpp_w.C_AGE!="00To15") & (snpp_w.C_AGE!="16To64") & (snpp_w.C_AGE!="65Plus")]
-      snpp_w.loc[snpp_w.C_AGE=="90Plus", "C_AGE"] = "90"
-      snpp_w.C_AGE = pd.to_numeric(snpp_w.C_AGE)
-
-      # convert gender to census convention 1=M, 2=F
-      snpp_w.GENDER = snpp_w.GENDER.map({"M": 1, "F": 2})
+      print(url)
+      # pages are fetched concurrently and converted as they arrive
+      snpp_w = pd.concat(_read_odata(url, _wales_chunk), ignore_index=True)
 
       #assert(len(snpp_w) == 26*2*91*22) # 22 LADs x 91 ages x 2 genders x 26 years
-      snpp_w.to_csv(wales_raw, index=False)
+      snpp_w = cache.write(snpp_w, wales_raw)
 
     return snpp_w
 
   def __do_scotland(self):
     print("Collating SNPP data for Scotland...")
 
-    scotland_raw = self.cache_dir + "/snpp_s.csv"
+    (cached, raw, scotland_src) = SNPPData.SOURCES[utils.SC]
+    scotland_raw = self.cache_dir + "/" + cached
+    scotland_zip = self.cache_dir + "/" + raw
 
-    scotland_src = "https://www.nrscotland.gov.uk/files//statistics/population-projections/sub-national-pp-16/detailed/CA%201.zip"
-    scotland_zip = self.cache_dir + "/snpp_s.zip"
+    snpp_s = cache.read(scotland_raw)
+    if snpp_s is None:
+      download.fetch(scotland_src, scotland_zip)
 
-    if os.path.isfile(scotland_raw): 
-      snpp_s = pd.read_csv(scotland_raw)
-    else: 
-      response = requests.get(scotland_src)
-      with open(scotland_zip, 'wb') as fd:
-        for chunk in response.iter_content(chunk_size=1024):
-          fd.write(chunk)
-        print("Downloaded", scotland_zip)
+      years = range(2016,2042)
+      genders = [1,2]
+      filenames = ["CA 1/Population-"+str(year)+("-Male" if gender==1 else "-Female")+".csv" for year in years for gender in genders]
+      tables = _read_zip_members(scotland_zip, filenames, _scotland_table)
 
-      z = zipfile.ZipFile(scotland_zip)
-      #print(z.namelist())  
-
-      snpp_s = pd.DataFrame()
-      for year in range(2016,2042):
-        for gender in [1,2]:
-          filename = "CA 1/Population-"+str(year)+("-Male" if gender==1 else "-Female")+".csv"
-          chunk = pd.read_csv(z.open(filename)
-          ).drop(["Area", "All Ages"], axis=1
-          ).drop(0 
-          ).rename(columns={"90 and over": "90"}
-          ).set_index("Code")
-
-          chunk = chunk.stack().reset_index() 
-          chunk.columns = ["GEOGRAPHY_CODE", "C_AGE", "OBS_VALUE"]
-          chunk["GENDER"] = gender
-          chunk["PROJECTED_YEAR_NAME"] = year
-          #print(chunk.head())
-          snpp_s = snpp_s.append(chunk)
+      # [year, gender, area, age], with the areas and ages (in order) of the first table
+      codes = tables[0].index
+      ages = tables[0].columns
+      values = np.empty((len(years), len(genders), len(codes), len(ages)))
+      for i, table in enumerate(tables):
+        values[i // len(genders), i % len(genders)] = table.reindex(index=codes, columns=ages).values
 
+      # construct the long-format data at once
+      snpp_s = Cube.frame(values.transpose(2, 0, 1, 3), [codes.values, years, genders, ages.astype(int)], Cube.AXES)
       print(len(snpp_s))
       #assert(len(snpp_s) == 26*2*91*32) # 32 districts x 91 ages x 2 genders x 26 years
-      snpp_s.to_csv(scotland_raw, index=False)
+      snpp_s = cache.write(snpp_s, scotland_raw)
     return snpp_s
 
   def __do_nireland(self):
     # Niron 
     # (1 worksheet per LAD equivalent)
     print("Collating SNPP data for Northern Ireland...")
-    ni_src = "https://www.nisra.gov.uk/sites/nisra.gov.uk/files/publications/SNPP16_LGD14_SYA_1641.xlsx"
-    ni_raw = self.cache_dir + "/snpp_ni.csv"
-    if os.path.isfile(ni_raw): 
-      snpp_ni = pd.read_csv(ni_raw)
-    else:
-      response = requests.get(ni_src)
-      with open(self.cache_dir + "/ni_raw.xlsx", 'wb') as fd:
-        for chunk in response.iter_content(chunk_size=1024):
-          fd.write(chunk)
-
-      # easier to hard-code the worksheet names we need (since unlikely to change frequently)
-      districts=["Antrim & Newtownabbey",
-                "Ards & North Down",
-                "Armagh Banbridge & Craigavon",
-                "Belfast",
-                "Causeway Coast & Glens",
-                "Derry & Strabane",
-                "Fermanagh & Omagh",
-                "Lisburn & Castlereagh",
-                "Mid & East Antrim",
-                "Mid Ulster",
-                "Newry Mourne & Down"]
-
-      xls_ni = load_workbook(self.cache_dir + "/ni_raw.xlsx", read_only=True)
-
-      snpp_ni = pd.DataFrame()
-
-      for d in districts:
+    (cached, raw, ni_src) = SNPPData.SOURCES[utils.NI]
+    ni_raw = self.cache_dir + "/" + cached
+    ni_xlsx = self.cache_dir + "/" + raw
+    snpp_ni = cache.read(ni_raw)
+    if snpp_ni is None:
+      download.fetch(ni_src, ni_xlsx)
+
+      xls_ni = load_workbook(ni_xlsx, read_only=True)
+
+      # [district, gender, age, year]
+      codes = []
+      values = []
+      for d in SNPPData.NI_DISTRICTS:
+        # each sheet is read in one pass (up to column AA, row 192)
+        sheet = _read_sheet(xls_ni[d], 192, 27)
         # 1 extra row compared to 2014 data (below was A2)
-        area_code = xls_ni[d]["A3"].value
+        codes.append(sheet[2, 0])
         # 2 extra rows compared to 2014 data (below was A3:A95)
-        males = _read_cell_range(xls_ni[d], "A5", "AA97")
-        females = _read_cell_range(xls_ni[d], "A100", "AA192")
-        
-        dfm = pd.DataFrame(data=males[1:,1:], index=males[1:,0], columns=males[0,1:]).drop(["Age"]).stack().reset_index()
-        dfm.columns=["C_AGE", "PROJECTED_YEAR_NAME", "OBS_VALUE"]
-        dfm["GENDER"] = pd.Series(1, dfm.index)
-        dfm["GEOGRAPHY_CODE"] = pd.Series(area_code, dfm.index)
-        dfm.loc[dfm.C_AGE=="90+", "C_AGE"] = "90"
-
-        dff = pd.DataFrame(data=females[1:,1:], index=females[1:,0], columns=females[0,1:]).drop(["Age"]).stack().reset_index()
-        dff.columns=["C_AGE", "PROJECTED_YEAR_NAME", "OBS_VALUE"]
-        dff["GENDER"] = pd.Series(2, dff.index)
-        dff["GEOGRAPHY_CODE"] = pd.Series(area_code, dff.index)
-        dff.loc[dff.C_AGE=="90+", "C_AGE"] = 90
-
-        snpp_ni = snpp_ni.append(dfm)
-        snpp_ni = snpp_ni.append(dff)
+        blocks = [_ni_block(sheet[4:97]), _ni_block(sheet[99:192])]
+        if not values:
+          (ages, years, _) = blocks[0]
+        for block in blocks:
+          if not np.array_equal(block[0], ages) or not np.array_equal(block[1], years):
+            raise ValueError("inconsistent ages/years in NI data for " + d)
+        values.append([block[2] for block in blocks])
+
+      # construct the long-format data for all districts and genders at once
+      snpp_ni = Cube.frame(np.array(values).transpose(0, 3, 1, 2), [codes, years, [1, 2], ages], Cube.AXES)
 
       #assert(len(snpp_ni) == 26*2*91*11) # 11 districts x 91 ages x 2 genders x 26 years
-      snpp_ni.to_csv(ni_raw, index=False)
+      snpp_ni = cache.write(snpp_ni, ni_raw)
 
     return snpp_ni
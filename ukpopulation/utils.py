@@ -4,6 +4,8 @@ Common utility functions for NPP/SNPP
 
 import os 
 from pathlib import Path
+import numpy as np
+import pandas as pd
 
 # Country enumerations
 EN = "en"
@@ -16,6 +18,9 @@ EW = [EN, WA]
 GB = [EN, WA, SC]
 UK = [EN, WA, SC, NI]
 
+# number of rows filtered and aggregated at a time (see aggregate)
+AGGREGATE_CHUNK_SIZE = 64 * 1024
+
 # ONS country codes
 CODES = {
   EN: "E92000001",
@@ -61,14 +66,41 @@ def check_and_invert(categories):
 
   return inverted
 
+def remove_unused_categories(data):
+  """
+  Removes the categories of categorical columns (i.e. GEOGRAPHY_CODE) that don't occur in data, e.g. after filtering,
+  so that a groupby on the data doesn't produce (empty) groups for them
+  """
+  for column in data.columns:
+    if isinstance(data[column].dtype, pd.CategoricalDtype):
+      data[column] = data[column].cat.remove_unused_categories()
+  return data
+
 def filter_by_age(data, age_range):
   return data[data.C_AGE.isin(age_range)]
 
-def aggregate(detail, categories):
+def aggregate(detail, categories, subset=None, chunk_size=AGGREGATE_CHUNK_SIZE):
   """
   Aggregate OBS_VALUE over categories
+  If subset, a dict of column (or index) name: values, is given only the rows whose values are among those are aggregated.
+  The rows are then filtered and aggregated chunk_size rows at a time, and the partial sums combined, so that the
+  filtered subset is never materialised
   """
-  return detail.groupby(check_and_invert(categories))["OBS_VALUE"].sum().reset_index()
+  preserved = check_and_invert(categories)
+  if subset is None:
+    return detail.groupby(preserved, observed=True)["OBS_VALUE"].sum().reset_index()
+
+  partials = Collector()
+  for start in range(0, max(len(detail), 1), chunk_size):
+    chunk = detail.iloc[start:start + chunk_size]
+    mask = np.ones(len(chunk), dtype=bool)
+    for column in subset:
+      values = chunk[column] if column in chunk.columns else chunk.index.get_level_values(column)
+      mask &= np.asarray(values.isin(subset[column]))
+    partials.add(chunk[mask].groupby(preserved, observed=True)["OBS_VALUE"].sum().reset_index())
+  if len(partials) == 1:
+    return remove_unused_categories(partials.chunks[0])
+  return remove_unused_categories(partials.result().groupby(preserved, observed=True)["OBS_VALUE"].sum().reset_index())
 
 def split_range(full_range, cutoff):
   """
@@ -91,4 +123,84 @@ def trim_range(input_range, minval, maxval):
   if isinstance(input_range, int) or isinstance(input_range, float):
     input_range = [input_range]
 
-  return [x for x in input_range if x >= minval and x <= maxval]
\ No newline at end of file
+  return [x for x in input_range if x >= minval and x <= maxval]
+
+class Collector:
+  """
+  Accumulates dataframe chunks that are concatenated (once) by result(), rather than growing a dataframe by repeated
+  appends, each of which copies everything accumulated so far
+  """
+  def __init__(self):
+    self.chunks = []
+
+  def add(self, chunk):
+    self.chunks.append(chunk)
+
+  def __len__(self):
+    return len(self.chunks)
+
+  def result(self):
+    """
+    Returns the chunks concatenated into a single dataframe (with a new index), or an empty dataframe if there are none
+    """
+    if not self.chunks:
+      return pd.DataFrame()
+    return pd.concat(self.chunks, ignore_index=True)
+
+class StreamWriter:
+  """
+  Writes dataframes to a CSV file, or a Parquet file if the filename ends .parquet (requires pyarrow), incrementally,
+  so that results need not all be held in memory at once. Can be used as a context manager
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self.parquet = os.path.splitext(filename)[1] == ".parquet"
+    self.rows = 0
+    self.header_written = False
+    if self.parquet:
+      try:
+        import pyarrow
+        import pyarrow.parquet
+      except ImportError:
+        raise ImportError("writing parquet requires the pyarrow package")
+      self.pyarrow = pyarrow
+      self.writer = None
+    else:
+      self.file = open(filename, "w", newline="")
+
+  def write(self, data):
+    if self.parquet:
+      # categorical columns are written as strings, since each chunk can have different categories
+      data = data.astype({column: str for column in data.columns if isinstance(data[column].dtype, pd.CategoricalDtype)})
+      table = self.pyarrow.Table.from_pandas(data, preserve_index=False)
+      if self.writer is None:
+        self.writer = self.pyarrow.parquet.ParquetWriter(self.filename, table.schema)
+      self.writer.write_table(table)
+    else:
+      # (the first chunks may be empty)
+      data.to_csv(self.file, header=not self.header_written, index=False)
+      self.header_written = True
+    self.rows += len(data)
+
+  def close(self):
+    if self.parquet:
+      if self.writer is not None:
+        self.writer.close()
+    else:
+      self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+def write_stream(results, filename):
+  """
+  Writes each dataframe from results, an iterable of dataframes or of (key, dataframe) pairs (e.g. SNPPData.iter_extrapolate),
+  to filename (see StreamWriter) as it is produced. Returns the number of rows written
+  """
+  with StreamWriter(filename) as writer:
+    for result in results:
+      writer.write(result[1] if isinstance(result, tuple) else result)
+  return writer.rows